@@ -9,18 +9,62 @@ What gets captured:
 - User prompts (full text)
 - Assistant responses (full text)
 - Tool invocations (name, input, output)
+- Images/binary payloads as references into a local content store
+  (CC_LANGFUSE_MEDIA=local|langfuse|drop)
 - Session grouping
 - Model info and timing
 
+Export sinks (CC_LANGFUSE_SINKS, comma-separated, default "langfuse"):
+- langfuse: traces with generation and tool spans
+- jsonl:    newline-delimited turn records, one file per project/day
+- columnar: Parquet/Arrow IPC tables partitioned by project/day (needs pyarrow)
+- null:     discard everything (parse/assemble benchmarking)
+
+Random access (`langfuse_hook.py index line|turn|last-assistant <transcript>`)
+seeks via a per-transcript sidecar index of line and turn offsets.
+
+Replay (`langfuse_hook.py replay <session> [--turns A-B]`) re-exports turns;
+trace and span ids are derived from session/turn/tool ids, so it is idempotent.
+
+Per-project routing (CC_LANGFUSE_ROUTES, a JSON file) sends each project's
+turns to its own Langfuse credentials; unmatched projects use LANGFUSE_*.
+
+Watch mode (`langfuse_hook.py watch`) tails transcripts via inotify (or
+polling) and emits turns as soon as they complete instead of on Stop.
+
 Opt-in: Only runs when TRACE_TO_LANGFUSE=true is set.
 Graceful failure: All errors exit 0 (non-blocking).
 """
 
+from __future__ import annotations
+
+import abc
+import argparse
+import base64
+import binascii
+import concurrent.futures
+import cProfile
+import ctypes
+import ctypes.util
 import fcntl
+import fnmatch
+import gzip
+import hashlib
+import io
 import json
+import mimetypes
 import os
+import pstats
 import re
+import select
+import shutil
+import struct
 import sys
+import time
+import tracemalloc
+import zlib
+from array import array
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
@@ -28,17 +72,90 @@ from typing import Any
 try:
     from langfuse import Langfuse
 except ImportError:
-    print("Error: langfuse package not installed. Run: pip install langfuse", file=sys.stderr)
-    sys.exit(0)
+    Langfuse = None  # Only required by the langfuse sink (checked in main)
+
+try:
+    from langfuse.media import LangfuseMedia
+except ImportError:
+    LangfuseMedia = None  # Only required for CC_LANGFUSE_MEDIA=langfuse
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # Only required by the columnar sink
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # Only required for .jsonl.zst transcripts
+
+CONFIG_WARNINGS = []  # Invalid settings, logged once logging is available
+
+
+def env_number(
+    name: str, default: float, cast: type = float, minimum: float | None = None, maximum: float | None = None
+) -> float:
+    """Read a numeric setting, keeping the default if the value does not parse.
+
+    Values outside [minimum, maximum] are clamped to the nearest bound.
+    Runs at import time, so a bad value must not raise: the hook promises
+    to exit 0 whatever happens.
+    """
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        number = cast(value)
+    except ValueError:
+        CONFIG_WARNINGS.append(f"Ignoring {name}={value!r}: not a valid {cast.__name__}, using {default}")
+        return default
+    bounded = number
+    if minimum is not None:
+        bounded = max(bounded, minimum)
+    if maximum is not None:
+        bounded = min(bounded, maximum)
+    if bounded != number:
+        CONFIG_WARNINGS.append(f"Clamping {name}={value!r} to {bounded}")
+    return bounded
+
 
 # Configuration
 LOG_FILE = Path.home() / ".claude" / "state" / "langfuse_hook.log"
 STATE_FILE = Path.home() / ".claude" / "state" / "langfuse_state.json"
 LOCK_FILE = Path.home() / ".claude" / "state" / "langfuse_state.lock"
+RUN_LOCK_FILE = Path.home() / ".claude" / "state" / "langfuse_run.lock"
+PROJECTS_DIR = Path.home() / ".claude" / "projects"
+MEDIA_DIR = Path.home() / ".claude" / "state" / "media"
+INDEX_DIR = Path.home() / ".claude" / "state" / "index"
+PROFILE_DIR = Path.home() / ".claude" / "state" / "profiles"
 DEBUG = os.environ.get("CC_LANGFUSE_DEBUG", "").lower() == "true"
 LOG_MAX_SIZE_BYTES = 10 * 1024 * 1024  # 10MB max log size
-LOG_BACKUP_COUNT = 3  # Keep 3 rotated logs
+LOG_BACKUP_COUNT = 3  # Keep 3 rotated logs (gzipped)
+SLOW_RUN_SECONDS = 180  # Runs longer than this get a warning
 REDACT_SECRETS = os.environ.get("CC_LANGFUSE_REDACT", "true").lower() == "true"
+MEDIA_MODE = os.environ.get("CC_LANGFUSE_MEDIA", "local").lower()  # local | langfuse | drop
+SINKS = [s.strip().lower() for s in os.environ.get("CC_LANGFUSE_SINKS", "langfuse").split(",") if s.strip()]
+EXPORT_DIR = Path(os.environ.get("CC_LANGFUSE_EXPORT_DIR", str(Path.home() / ".claude" / "state" / "exports")))
+ROUTES_FILE = Path(os.environ.get("CC_LANGFUSE_ROUTES", str(Path.home() / ".claude" / "langfuse_routes.json")))
+FLUSH_WORKERS = 8  # Max Langfuse clients flushed in parallel
+COLUMNAR_FORMAT = os.environ.get("CC_LANGFUSE_COLUMNAR_FORMAT", "parquet").lower()  # parquet | arrow
+COLUMNAR_ROLL_BYTES = int(env_number("CC_LANGFUSE_COLUMNAR_ROLL_MB", 64.0) * 1024 * 1024)  # Staged rows per file
+COLUMNAR_ROLL_SECONDS = env_number("CC_LANGFUSE_COLUMNAR_ROLL_SECONDS", 3600.0)  # Max age of staged rows
+PROFILE_MODE = os.environ.get("CC_LANGFUSE_PROFILE", "").lower()  # always | slow
+PROFILE_THRESHOLD = env_number("CC_LANGFUSE_PROFILE_THRESHOLD", SLOW_RUN_SECONDS)
+PROFILE_TRACE_FRAMES = env_number("CC_LANGFUSE_PROFILE_FRAMES", 1, int, 1, 65535)  # Stack depth per allocation; more is slower
+PROFILE_TOP_N = 30
+PROFILE_KEEP = 10  # Captures retained in PROFILE_DIR
+TIME_BUDGET = env_number("CC_LANGFUSE_TIME_BUDGET", 0.0)  # Seconds per run, 0 = unlimited
+HOOK_INPUT_TIMEOUT = 1.0  # Seconds to wait for the Stop hook payload on stdin
+RUN_LOCK_POLL = 0.2  # Seconds between attempts to take the run lock under a time budget
+CHECKPOINT_TURNS = env_number("CC_LANGFUSE_CHECKPOINT_TURNS", 50, int)  # Flush + save cursor every N turns
+SUMMARY_INTERVAL = env_number("CC_LANGFUSE_SUMMARY_INTERVAL", 300.0)  # Min seconds between session summaries
+WATCH_DEBOUNCE = env_number("CC_LANGFUSE_WATCH_DEBOUNCE", 2.0, minimum=0.0)  # Quiet period before reading
+WATCH_MAX_DELAY = env_number("CC_LANGFUSE_WATCH_MAX_DELAY", 30.0, minimum=0.0)  # Cap on debounce during long bursts
+WATCH_POLL_INTERVAL = env_number("CC_LANGFUSE_WATCH_POLL", 5.0, minimum=0.0)  # Polling fallback interval
 
 # Patterns for secret redaction (conservative - only obvious secrets)
 SECRET_PATTERNS = [
@@ -50,21 +167,38 @@ SECRET_PATTERNS = [
     (r'api[_-]?key["\']?\s*[:=]\s*["\']?[a-zA-Z0-9._-]{16,}', 'api_key: [REDACTED]'),  # API keys
 ]
 
+# Transcript files: live .jsonl plus archives compressed by retention jobs
+TRANSCRIPT_SUFFIX = ".jsonl"
+COMPRESSED_SUFFIXES = (".jsonl.gz", ".jsonl.zst")
+# Errors reading a transcript: I/O, truncated archives, corrupt deflate or zstd
+# data, and bytes that are not UTF-8
+TRANSCRIPT_READ_ERRORS = (OSError, EOFError, zlib.error, UnicodeDecodeError) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+# Content blocks carrying inline base64 payloads (screenshots, image reads, PDFs)
+BINARY_BLOCK_TYPES = ("image", "document")
+DATA_URI_PATTERN = re.compile(r"data:([\w.+-]+/[\w.+-]+);base64,")
+
 
 def rotate_log_if_needed() -> None:
-    """Rotate log file if it exceeds max size."""
+    """Rotate log file if it exceeds max size, gzipping the rotated copy."""
     if not LOG_FILE.exists():
         return
     try:
         if LOG_FILE.stat().st_size > LOG_MAX_SIZE_BYTES:
             # Rotate existing backups
             for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
-                old = LOG_FILE.with_suffix(f".log.{i}")
-                new = LOG_FILE.with_suffix(f".log.{i + 1}")
+                old = LOG_FILE.with_suffix(f".log.{i}.gz")
+                new = LOG_FILE.with_suffix(f".log.{i + 1}.gz")
                 if old.exists():
                     old.rename(new)
-            # Rotate current log
-            LOG_FILE.rename(LOG_FILE.with_suffix(".log.1"))
+            # Move the current log aside atomically, then compress it
+            pending = LOG_FILE.with_suffix(f".log.1.{os.getpid()}")
+            LOG_FILE.rename(pending)
+            with open(pending, "rb") as src, gzip.open(LOG_FILE.with_suffix(".log.1.gz"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            pending.unlink()
     except (IOError, OSError):
         pass  # Ignore rotation errors
 
@@ -100,17 +234,87 @@ def sanitize_text(text: str) -> str:
     return result
 
 
+def is_binary_block(value: Any) -> bool:
+    """Check if a content block carries an inline base64 payload."""
+    if not isinstance(value, dict) or value.get("type") not in BINARY_BLOCK_TYPES:
+        return False
+    source = value.get("source")
+    return isinstance(source, dict) and source.get("type") == "base64"
+
+
+def store_media(data: str, media_type: str) -> dict:
+    """Store a base64 payload once in the local content store and return a reference.
+
+    Files are content-addressed (MEDIA_DIR/<sha[:2]>/<sha><ext>), so repeated
+    screenshots are written only once. With CC_LANGFUSE_MEDIA=drop, only the
+    reference metadata is kept.
+    """
+    try:
+        raw = base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        raw = data.encode()
+        media_type = "application/octet-stream"
+    digest = hashlib.sha256(raw).hexdigest()
+    ref = {"type": "media_ref", "media_type": media_type, "bytes": len(raw), "sha256": digest}
+    if MEDIA_MODE == "drop":
+        return ref
+
+    path = MEDIA_DIR / digest[:2] / f"{digest}{mimetypes.guess_extension(media_type) or '.bin'}"
+    if not path.exists():
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f"{path.suffix}.tmp.{os.getpid()}")
+            tmp_path.write_bytes(raw)
+            os.replace(str(tmp_path), str(path))
+        except OSError as e:
+            log("WARN", f"Failed to store media {digest}: {e}")
+            return ref
+    ref["path"] = str(path)
+    return ref
+
+
 def sanitize_value(value: Any) -> Any:
-    """Recursively sanitize a value (string, dict, or list)."""
+    """Recursively sanitize a value (string, dict, or list).
+
+    Binary content (base64 image/document blocks and data URIs) is not
+    scanned for secrets; it is moved to the content store and replaced by a
+    small media_ref.
+    """
     if isinstance(value, str):
+        if value.startswith("data:"):
+            match = DATA_URI_PATTERN.match(value)
+            if match:
+                return store_media(value[match.end():], match.group(1))
         return sanitize_text(value)
     elif isinstance(value, dict):
+        if is_binary_block(value):
+            source = value["source"]
+            return {"type": value["type"], "source": store_media(source.get("data", ""), source.get("media_type", ""))}
         return {k: sanitize_value(v) for k, v in value.items()}
     elif isinstance(value, list):
         return [sanitize_value(item) for item in value]
     return value
 
 
+def attach_langfuse_media(value: Any) -> Any:
+    """Replace stored media_refs with LangfuseMedia objects for upload.
+
+    The Langfuse SDK uploads these through its media endpoint (S3/MinIO)
+    and keeps only a media reference string in the observation payload.
+    """
+    if isinstance(value, dict):
+        if value.get("type") == "media_ref" and value.get("path"):
+            try:
+                return LangfuseMedia(content_bytes=Path(value["path"]).read_bytes(), content_type=value["media_type"])
+            except (OSError, ValueError) as e:
+                debug(f"Keeping local media reference for {value['sha256']}: {e}")
+                return value
+        return {k: attach_langfuse_media(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [attach_langfuse_media(item) for item in value]
+    return value
+
+
 def load_state() -> dict:
     """Load the state file with corruption recovery.
 
@@ -156,74 +360,187 @@ def save_state(state: dict) -> None:
             pass
 
 
-def get_content(msg: dict) -> Any:
-    """Extract content from a message."""
-    if isinstance(msg, dict):
-        if "message" in msg:
-            return msg["message"].get("content")
-        return msg.get("content")
-    return None
+def message_role(msg: Any) -> str | None:
+    """Return the role of a decoded transcript line ("user", "assistant", ...), or None."""
+    if type(msg) is not dict:
+        return None
+    message = msg.get("message")
+    return msg.get("type") or (message.get("role") if type(message) is dict else None)
 
 
-def is_tool_result(msg: dict) -> bool:
-    """Check if a message contains tool results."""
-    content = get_content(msg)
-    if isinstance(content, list):
-        return any(
-            isinstance(item, dict) and item.get("type") == "tool_result"
-            for item in content
-        )
-    return False
-
-
-def get_tool_calls(msg: dict) -> list:
-    """Extract tool use blocks from a message."""
-    content = get_content(msg)
-    if isinstance(content, list):
-        return [
-            item for item in content
-            if isinstance(item, dict) and item.get("type") == "tool_use"
-        ]
-    return []
-
-
-def get_text_content(msg: dict) -> str:
-    """Extract text content from a message."""
-    content = get_content(msg)
-    if isinstance(content, str):
-        return content
-    if isinstance(content, list):
-        text_parts = []
+def message_content(msg: dict) -> Any:
+    """Return a line's content, from its nested message or the flat format."""
+    message = msg.get("message")
+    return message.get("content") if type(message) is dict else msg.get("content")
+
+
+def text_parts(content: Any) -> list:
+    """Return the text of a message's content: the string itself, or its text blocks."""
+    if type(content) is str:
+        return [content]
+    parts = []
+    if type(content) is list:
         for item in content:
-            if isinstance(item, dict) and item.get("type") == "text":
-                text_parts.append(item.get("text", ""))
-            elif isinstance(item, str):
-                text_parts.append(item)
-        return "\n".join(text_parts)
-    return ""
+            if type(item) is dict:
+                if item.get("type") == "text":
+                    parts.append(item.get("text", ""))
+            elif type(item) is str:
+                parts.append(item)
+    return parts
 
 
-def merge_assistant_parts(parts: list) -> dict:
-    """Merge multiple assistant message parts into one."""
-    if not parts:
-        return {}
+class ToolCall:
+    """A tool_use block, filled in with its tool_result once that arrives."""
 
-    merged_content = []
-    for part in parts:
-        content = get_content(part)
-        if isinstance(content, list):
-            merged_content.extend(content)
-        elif content:
-            merged_content.append({"type": "text", "text": str(content)})
-
-    result = parts[0].copy()
-    if "message" in result:
-        result["message"] = result["message"].copy()
-        result["message"]["content"] = merged_content
-    else:
-        result["content"] = merged_content
+    __slots__ = ("id", "name", "input", "output", "is_error")
 
-    return result
+    def __init__(self, block: dict):
+        self.id = block.get("id", "")
+        self.name = block.get("name", "unknown")
+        self.input = block.get("input", {})
+        self.output = None
+        self.is_error = False
+
+
+class AssistantMessage:
+    """One assistant message, merged from every transcript line sharing its id.
+
+    Turn.add_assistant_part appends each part's text and tool_use blocks,
+    so the raw line dicts never need to be copied or kept.
+    """
+
+    __slots__ = ("msg_id", "model", "stop_reason", "text_parts", "tool_calls")
+
+    def __init__(self, msg_id: str | None, model: str):
+        self.msg_id = msg_id
+        self.model = model
+        self.stop_reason = None
+        self.text_parts = []
+        self.tool_calls = []
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.text_parts)
+
+
+class Turn:
+    """A user prompt plus the assistant messages and tool results answering it.
+
+    line_index/offset locate the user message in the transcript so a turn
+    that is still in progress can be re-read from its start.
+    """
+
+    __slots__ = ("user_text", "timestamp", "end_timestamp", "line_index", "offset", "assistants", "tool_calls_by_id")
+
+    def __init__(self, user_msg: dict, line_index: int = 0, offset: int = 0):
+        self.user_text = "\n".join(text_parts(message_content(user_msg)))
+        self.timestamp = self.end_timestamp = user_msg.get("timestamp")
+        self.line_index = line_index
+        self.offset = offset
+        self.assistants = []
+        self.tool_calls_by_id = {}
+
+    def add_assistant_part(self, msg: dict) -> None:
+        """Add an assistant line in one pass over its content, merging it into the current message if the id matches."""
+        message = msg.get("message")
+        if type(message) is dict:
+            msg_id = message.get("id")
+            content = message.get("content")
+        else:
+            message = None
+            msg_id = None
+            content = msg.get("content")
+
+        assistants = self.assistants
+        current = assistants[-1] if assistants else None
+        # Lines without an id continue the current message
+        if current is None or (msg_id and msg_id != current.msg_id):
+            current = AssistantMessage(msg_id, message.get("model", "claude") if message else "claude")
+            assistants.append(current)
+        current.stop_reason = message.get("stop_reason") if message else None
+        timestamp = msg.get("timestamp")
+        if timestamp:
+            self.end_timestamp = timestamp
+
+        if type(content) is str:
+            current.text_parts.append(content)
+        elif type(content) is list:
+            for item in content:
+                if type(item) is dict:
+                    kind = item.get("type")
+                    if kind == "text":
+                        current.text_parts.append(item.get("text", ""))
+                    elif kind == "tool_use":
+                        tool_call = ToolCall(item)
+                        current.tool_calls.append(tool_call)
+                        self.tool_calls_by_id[tool_call.id] = tool_call
+                elif type(item) is str:
+                    current.text_parts.append(item)
+
+    def add_tool_results(self, blocks: list, timestamp: str | None = None) -> None:
+        """Attach tool_result blocks to the tool calls they answer."""
+        if timestamp:
+            self.end_timestamp = timestamp
+        for block in blocks:
+            tool_call = self.tool_calls_by_id.get(block.get("tool_use_id"))
+            if tool_call is not None:
+                tool_call.output = block.get("content")
+                tool_call.is_error = bool(block.get("is_error"))
+
+    @property
+    def tool_calls(self) -> list:
+        return [tool_call for assistant in self.assistants for tool_call in assistant.tool_calls]
+
+    @property
+    def is_complete(self) -> bool:
+        """True once the last assistant message ended the turn.
+
+        Any stop reason other than tool_use (end_turn, max_tokens,
+        stop_sequence, refusal, ...) ends it; None means still streaming.
+        """
+        return bool(self.assistants) and self.assistants[-1].stop_reason not in (None, "tool_use")
+
+
+class TurnGrouper:
+    """Groups decoded transcript lines into Turns as they are read.
+
+    A turn is: user message -> assistant message(s) -> tool results.
+    Each line's content list is scanned once, by whichever of Turn's
+    methods the line's role selects; no per-line object is built.
+    add() returns the previous turn when a new user prompt closes it;
+    the turn still being built is available as `current`.
+    """
+
+    __slots__ = ("current",)
+
+    def __init__(self):
+        self.current = None
+
+    def add(self, msg: Any, line_index: int = 0, offset: int = 0) -> Turn | None:
+        if type(msg) is not dict:
+            return None
+        message = msg.get("message")
+        if type(message) is dict:
+            role = msg.get("type") or message.get("role")
+        else:
+            message = None
+            role = msg.get("type")
+
+        if role == "user":
+            # User messages containing tool_result blocks belong to the current turn
+            content = message.get("content") if message else msg.get("content")
+            if type(content) is list:
+                results = [item for item in content if type(item) is dict and item.get("type") == "tool_result"]
+                if results:
+                    if self.current is not None:
+                        self.current.add_tool_results(results, msg.get("timestamp"))
+                    return None
+            finished, self.current = self.current, Turn(msg, line_index, offset)
+            return finished
+
+        if role == "assistant" and self.current is not None:
+            self.current.add_assistant_part(msg)
+        return None
 
 
 def extract_project_name(project_dir: Path) -> str:
@@ -243,15 +560,89 @@ def extract_project_name(project_dir: Path) -> str:
     return dir_name
 
 
+def is_compressed(transcript_file: Path) -> bool:
+    return transcript_file.name.endswith(COMPRESSED_SUFFIXES)
+
+
+def is_transcript(path: Path) -> bool:
+    """Check if a file is a live or archived transcript we can read."""
+    if path.name.endswith(".jsonl.zst"):
+        return zstandard is not None
+    return path.name.endswith((TRANSCRIPT_SUFFIX, ".jsonl.gz"))
+
+
+def transcript_stem(transcript_file: Path) -> str:
+    """File name without .jsonl[.gz|.zst], i.e. the session id by convention."""
+    return transcript_file.name[:transcript_file.name.rindex(TRANSCRIPT_SUFFIX)]
+
+
+class ForwardSeekReader(io.BufferedReader):
+    """Buffered reader over a decompressing stream that cannot seek itself.
+
+    seek() reads and discards bytes up to the target, as GzipFile does, so
+    decompressed-stream offsets work for .zst archives too.
+    """
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        position = self.tell()
+        if whence == io.SEEK_CUR:
+            offset += position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("compressed transcripts cannot seek from the end")
+        if offset < position:
+            raise io.UnsupportedOperation("compressed transcripts only seek forward")
+        while position < offset:
+            chunk = self.read(min(offset - position, io.DEFAULT_BUFFER_SIZE * 64))
+            if not chunk:
+                break
+            position += len(chunk)
+        return position
+
+
+def open_transcript(transcript_file: Path):
+    """Open a transcript for binary reading, decompressing on the fly.
+
+    Offsets in state and the index always refer to the decompressed stream,
+    so an archived transcript continues from the cursor of its live file.
+    Compressed streams only seek forward (by decompressing up to the offset).
+    """
+    name = transcript_file.name
+    if name.endswith(".gz"):
+        return gzip.open(transcript_file, "rb")
+    if name.endswith(".zst"):
+        reader = zstandard.ZstdDecompressor().stream_reader(open(transcript_file, "rb"), closefd=True)
+        return ForwardSeekReader(reader)
+    return open(transcript_file, "rb")
+
+
+def describe_transcript(transcript_file: Path) -> tuple[str, Path, str]:
+    """Return (session_id, transcript_path, project_name) for a transcript file.
+
+    Only the first line is read; the session id falls back to the file stem.
+    """
+    with open_transcript(transcript_file) as f:
+        first_line = f.readline()
+    session_id = transcript_stem(transcript_file)
+    if first_line.strip():
+        first_msg = json.loads(first_line)
+        if isinstance(first_msg, dict):
+            session_id = first_msg.get("sessionId", session_id)
+    return session_id, transcript_file, extract_project_name(transcript_file.parent)
+
+
 def find_all_transcripts() -> list[tuple[str, Path, str]]:
     """Find all transcript files across all project directories.
 
     Claude Code stores transcripts as .jsonl files in:
     ~/.claude/projects/<project-dir>/<session-id>.jsonl
+    Archived .jsonl.gz (and .jsonl.zst with zstandard installed) are included.
 
-    Returns: list of (session_id, transcript_path, project_name), sorted by mtime (oldest first)
+    Returns: list of (session_id, transcript_path, project_name), sorted by mtime (newest first)
     """
-    projects_dir = Path.home() / ".claude" / "projects"
+    projects_dir = PROJECTS_DIR
 
     if not projects_dir.exists():
         debug(f"Projects directory not found: {projects_dir}")
@@ -262,34 +653,33 @@ def find_all_transcripts() -> list[tuple[str, Path, str]]:
     for project_dir in projects_dir.iterdir():
         if not project_dir.is_dir():
             continue
-        for transcript_file in project_dir.glob("*.jsonl"):
+        for transcript_file in project_dir.iterdir():
+            if not is_transcript(transcript_file):
+                continue
             try:
                 mtime = transcript_file.stat().st_mtime
-                first_line = transcript_file.read_text().split("\n")[0]
-                first_msg = json.loads(first_line)
-                session_id = first_msg.get("sessionId", transcript_file.stem)
-                project_name = extract_project_name(project_dir)
+                session_id, _, project_name = describe_transcript(transcript_file)
                 transcripts.append((session_id, transcript_file, project_name, mtime))
-            except (json.JSONDecodeError, IOError, IndexError) as e:
+            except (json.JSONDecodeError, IndexError, *TRANSCRIPT_READ_ERRORS) as e:
                 debug(f"Skipping unreadable transcript {transcript_file}: {e}")
                 continue
 
-    # Sort by mtime ascending (oldest first) so newest state is written last
-    transcripts.sort(key=lambda t: t[3])
+    # Most recently active sessions first, so a time-budgeted run serves them first
+    transcripts.sort(key=lambda t: t[3], reverse=True)
 
     return [(sid, path, proj) for sid, path, proj, _ in transcripts]
 
 
-def create_trace(
-    langfuse: Langfuse,
-    session_id: str,
-    turn_num: int,
-    user_msg: dict,
-    assistant_msgs: list,
-    tool_results: list,
-    project_name: str = "",
-) -> None:
-    """Create a Langfuse trace for a single conversation turn.
+def stable_id(*parts: Any, length: int = 32) -> str:
+    """Derive a hex id from its parts, so re-exports reuse the same ids.
+
+    32 hex chars is a W3C/OTEL trace id, 16 a span id.
+    """
+    return hashlib.sha256(":".join(str(part) for part in parts).encode()).hexdigest()[:length]
+
+
+def build_turn_record(session_id: str, turn_num: int, turn: Turn, project_name: str = "") -> dict:
+    """Assemble a sink-agnostic record for a single conversation turn.
 
     A turn consists of:
     - User message
@@ -297,48 +687,93 @@ def create_trace(
     - Tool calls (if any)
     - Tool results (if any)
 
+    Text and tool payloads are sanitized here, so every sink receives
+    the same redacted data. Trace and span ids are derived from session id,
+    turn number and tool_use id, so exporting a turn twice is idempotent.
+    """
+    assistants = turn.assistants
+    return {
+        "trace_id": stable_id("trace", session_id, turn_num),
+        "span_id": stable_id("turn", session_id, turn_num, length=16),
+        "generation_id": stable_id("generation", session_id, turn_num, length=16),
+        "session_id": session_id,
+        "turn_number": turn_num,
+        "project": project_name,
+        "timestamp": turn.timestamp,
+        "end_timestamp": turn.end_timestamp,
+        "model": assistants[0].model if assistants else "claude",
+        "input": sanitize_text(turn.user_text),
+        "output": sanitize_text(assistants[-1].text) if assistants else "",
+        "tool_calls": [
+            {
+                "name": tool_call.name,
+                "input": sanitize_value(tool_call.input),
+                "output": sanitize_value(tool_call.output),
+                "is_error": tool_call.is_error,
+                "id": tool_call.id,
+                "span_id": stable_id("tool", session_id, tool_call.id or f"{turn_num}:{position}", length=16),
+            }
+            for position, tool_call in enumerate(turn.tool_calls)
+        ],
+    }
+
+
+class StableIdGenerator:
+    """OpenTelemetry id generator that hands out a preset span id once.
+
+    Installed on the Langfuse client's tracer so spans reuse the record's
+    deterministic ids; any span started without a preset id gets one from
+    the original generator.
+    """
+
+    def __init__(self, fallback: Any):
+        self.fallback = fallback
+        self.next_span_id = None
+
+    def preset(self, span_id: str) -> None:
+        self.next_span_id = int(span_id, 16)
+
+    def generate_span_id(self) -> int:
+        span_id, self.next_span_id = self.next_span_id, None
+        return span_id if span_id is not None else self.fallback.generate_span_id()
+
+    def generate_trace_id(self) -> int:
+        return self.fallback.generate_trace_id()
+
+
+def install_stable_ids(langfuse: Langfuse) -> StableIdGenerator | None:
+    """Swap the client's OTEL id generator for a StableIdGenerator.
+
+    Relies on SDK internals (the client's tracer and its id_generator); if
+    they are not present, span ids stay random while trace ids remain
+    deterministic via trace_context.
+    """
+    tracer = getattr(langfuse, "_otel_tracer", None)
+    fallback = getattr(tracer, "id_generator", None)
+    if fallback is None or not hasattr(fallback, "generate_span_id"):
+        debug("Tracer id generator not accessible; span ids will not be deterministic")
+        return None
+    generator = StableIdGenerator(fallback)
+    tracer.id_generator = generator
+    return generator
+
+
+def create_trace(langfuse: Langfuse, record: dict, ids: StableIdGenerator | None = None) -> None:
+    """Create a Langfuse trace for a single conversation turn.
+
     The trace is structured as:
     - Trace (top-level container)
       - Generation span (Claude's response)
       - Tool spans (one per tool call)
+
+    The trace id comes from the record; span ids too when `ids` is given.
     """
-    user_text = sanitize_text(get_text_content(user_msg))
-
-    # Get final assistant output
-    final_output = ""
-    if assistant_msgs:
-        final_output = sanitize_text(get_text_content(assistant_msgs[-1]))
-
-    # Extract model info from first assistant message
-    model = "claude"
-    if assistant_msgs and isinstance(assistant_msgs[0], dict) and "message" in assistant_msgs[0]:
-        model = assistant_msgs[0]["message"].get("model", "claude")
-
-    # Collect all tool calls with their results
-    all_tool_calls = []
-    for assistant_msg in assistant_msgs:
-        tool_calls = get_tool_calls(assistant_msg)
-        for tool_call in tool_calls:
-            tool_name = tool_call.get("name", "unknown")
-            tool_input = tool_call.get("input", {})
-            tool_id = tool_call.get("id", "")
-
-            # Find matching tool result
-            tool_output = None
-            for tr in tool_results:
-                tr_content = get_content(tr)
-                if isinstance(tr_content, list):
-                    for item in tr_content:
-                        if isinstance(item, dict) and item.get("tool_use_id") == tool_id:
-                            tool_output = item.get("content")
-                            break
-
-            all_tool_calls.append({
-                "name": tool_name,
-                "input": sanitize_value(tool_input),
-                "output": sanitize_value(tool_output),
-                "id": tool_id,
-            })
+    session_id = record["session_id"]
+    turn_num = record["turn_number"]
+    project_name = record["project"]
+    user_text = record["input"]
+    final_output = record["output"]
+    all_tool_calls = record["tool_calls"]
 
     # Build tags for filtering
     tags = ["claude-code"]
@@ -346,7 +781,10 @@ def create_trace(
         tags.append(project_name)
 
     # Create the trace with spans for each tool call
+    if ids is not None:
+        ids.preset(record["span_id"])
     with langfuse.start_as_current_span(
+        trace_context={"trace_id": record["trace_id"]},
         name=f"Turn {turn_num}",
         input={"role": "user", "content": user_text},
         metadata={
@@ -368,10 +806,12 @@ def create_trace(
         )
 
         # Create generation span for Claude's response
+        if ids is not None:
+            ids.preset(record["generation_id"])
         with langfuse.start_as_current_observation(
             name="Claude Response",
             as_type="generation",
-            model=model,
+            model=record["model"],
             input={"role": "user", "content": user_text},
             output={"role": "assistant", "content": final_output},
             metadata={"tool_count": len(all_tool_calls)},
@@ -380,6 +820,8 @@ def create_trace(
 
         # Create spans for each tool call
         for tool_call in all_tool_calls:
+            if ids is not None:
+                ids.preset(tool_call["span_id"])
             with langfuse.start_as_current_span(
                 name=f"Tool: {tool_call['name']}",
                 input=tool_call["input"],
@@ -397,142 +839,1401 @@ def create_trace(
     debug(f"Created trace for turn {turn_num}")
 
 
-def process_transcript(langfuse: Langfuse, session_id: str, transcript_file: Path, state: dict, project_name: str = "") -> int:
+def parse_timestamp(ts: Any) -> datetime | None:
+    """Parse a transcript ISO timestamp ("...Z" or with offset) to an aware UTC datetime."""
+    if not isinstance(ts, str):
+        return None
+    try:
+        return datetime.fromisoformat(ts.replace("Z", "+00:00")).astimezone(timezone.utc)
+    except ValueError:
+        return None
+
+
+def text_chars(value: Any) -> int:
+    """Count the characters of every string in a sanitized value, without serializing it."""
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(text_chars(v) for v in value.values())
+    if isinstance(value, list):
+        return sum(text_chars(item) for item in value)
+    return 0
+
+
+def update_rollup(rollup: dict, record: dict) -> None:
+    """Fold one emitted turn record into a session's running aggregates.
+
+    The rollup lives in the session's state entry, so views that need
+    per-session totals read one summary instead of every turn trace.
+    first_turn records where aggregation began for sessions that predate it.
+    """
+    rollup.setdefault("first_turn", record["turn_number"])
+    rollup["turns"] = rollup.get("turns", 0) + 1
+    chars = len(record["input"]) + len(record["output"])
+    tools = rollup.setdefault("tool_calls", {})
+    for tool_call in record["tool_calls"]:
+        tools[tool_call["name"]] = tools.get(tool_call["name"], 0) + 1
+        if tool_call.get("is_error"):
+            rollup["tool_errors"] = rollup.get("tool_errors", 0) + 1
+        chars += text_chars(tool_call["input"]) + text_chars(tool_call["output"])
+    rollup["content_chars"] = rollup.get("content_chars", 0) + chars
+
+    start, end = parse_timestamp(record.get("timestamp")), parse_timestamp(record.get("end_timestamp"))
+    if start is not None and end is not None:
+        rollup["active_seconds"] = round(rollup.get("active_seconds", 0.0) + max((end - start).total_seconds(), 0.0), 3)
+    if start is not None and (not rollup.get("started") or start < parse_timestamp(rollup["started"])):
+        rollup["started"] = start.isoformat()
+    if end is not None and (not rollup.get("ended") or end > parse_timestamp(rollup["ended"])):
+        rollup["ended"] = end.isoformat()
+
+
+def build_session_summary(session_id: str, project_name: str, rollup: dict) -> dict:
+    """Assemble a sink-agnostic session summary record from a rollup."""
+    started, ended = parse_timestamp(rollup.get("started")), parse_timestamp(rollup.get("ended"))
+    return {
+        "trace_id": stable_id("session", session_id),
+        "span_id": stable_id("session", session_id, length=16),
+        "session_id": session_id,
+        "project": project_name,
+        "timestamp": rollup.get("started"),
+        "first_turn": rollup.get("first_turn", 1),
+        "turns": rollup.get("turns", 0),
+        "tool_calls": dict(rollup.get("tool_calls", {})),
+        "tool_call_count": sum(rollup.get("tool_calls", {}).values()),
+        "tool_errors": rollup.get("tool_errors", 0),
+        "content_chars": rollup.get("content_chars", 0),
+        "active_seconds": rollup.get("active_seconds", 0.0),
+        "wall_seconds": round((ended - started).total_seconds(), 3) if started and ended else 0.0,
+        "started": rollup.get("started"),
+        "ended": rollup.get("ended"),
+    }
+
+
+def create_session_summary(langfuse: Langfuse, summary: dict, ids: StableIdGenerator | None = None) -> None:
+    """Upsert a session's summary trace and numeric session scores.
+
+    The trace and score ids derive from the session id, so each update
+    overwrites the previous summary instead of adding another one.
+    """
+    session_id = summary["session_id"]
+    tags = ["claude-code", "session-summary"]
+    if summary["project"]:
+        tags.append(summary["project"])
+
+    if ids is not None:
+        ids.preset(summary["span_id"])
+    with langfuse.start_as_current_span(
+        trace_context={"trace_id": summary["trace_id"]},
+        name="Session summary",
+        output=summary,
+        metadata={"source": "claude-code", "project": summary["project"]},
+    ):
+        langfuse.update_current_trace(session_id=session_id, tags=tags, metadata=summary)
+
+    for name in ("turns", "tool_call_count", "tool_errors", "content_chars", "active_seconds", "wall_seconds"):
+        langfuse.create_score(
+            score_id=stable_id("score", session_id, name),
+            session_id=session_id,
+            name=f"session.{name}",
+            value=float(summary[name]),
+            data_type="NUMERIC",
+        )
+    debug(f"Updated session summary for {session_id}")
+
+
+def record_partition(record: dict) -> tuple[str, str]:
+    """Return the (project, UTC day) partition a turn record belongs to."""
+    project = record.get("project") or "unknown"
+    ts = parse_timestamp(record.get("timestamp"))
+    day = (ts or datetime.now(timezone.utc)).strftime("%Y-%m-%d")
+    # Keep partition values path-safe
+    return re.sub(r"[^A-Za-z0-9._-]", "_", project), day
+
+
+class Sink(abc.ABC):
+    """Export destination for assembled turn records.
+
+    Sinks receive records via emit() and must not raise for per-record
+    problems; flush() is called once at the end of a run and shutdown()
+    always runs, even after errors. emit_session() receives session
+    summaries and is optional. emit() is abstract, so a sink missing it
+    fails when it is built rather than mid-run.
+    """
+
+    name = "sink"
+
+    @abc.abstractmethod
+    def emit(self, record: dict) -> None:
+        """Export one turn record."""
+
+    def emit_session(self, summary: dict) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def shutdown(self) -> None:
+        pass
+
+
+class NullSink(Sink):
+    """Discards every record. Used to benchmark parse/assemble throughput."""
+
+    name = "null"
+
+    def emit(self, record: dict) -> None:
+        pass
+
+
+class LangfuseSink(Sink):
+    """Sends each turn to Langfuse as a trace with generation and tool spans."""
+
+    name = "langfuse"
+
+    def __init__(self, client: Langfuse):
+        self.client = client
+        self.ids = install_stable_ids(client)
+
+    def emit(self, record: dict) -> None:
+        if MEDIA_MODE == "langfuse" and LangfuseMedia is not None:
+            record = dict(record, tool_calls=[
+                dict(tool_call, input=attach_langfuse_media(tool_call["input"]), output=attach_langfuse_media(tool_call["output"]))
+                for tool_call in record["tool_calls"]
+            ])
+        create_trace(self.client, record, self.ids)
+
+    def emit_session(self, summary: dict) -> None:
+        create_session_summary(self.client, summary, self.ids)
+
+    def flush(self) -> None:
+        self.client.flush()
+
+    def shutdown(self) -> None:
+        self.client.shutdown()
+
+
+class JsonlSink(Sink):
+    """Appends turn records as NDJSON to <root>/<project>/<YYYY-MM-DD>.jsonl.
+
+    Session summaries replace <root>/<project>/sessions/<session_id>.json.
+    """
+
+    name = "jsonl"
+
+    def __init__(self, root: Path):
+        self.root = root
+        self._handles = {}
+
+    def emit(self, record: dict) -> None:
+        project, day = record_partition(record)
+        handle = self._handles.get((project, day))
+        if handle is None:
+            path = self.root / project / f"{day}.jsonl"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            handle = open(path, "a")
+            self._handles[(project, day)] = handle
+        handle.write(json.dumps(record, default=str) + "\n")
+
+    def emit_session(self, summary: dict) -> None:
+        project, _ = record_partition(summary)
+        path = self.root / project / "sessions" / f"{summary['session_id']}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(f".json.tmp.{os.getpid()}")
+        tmp_path.write_text(json.dumps(summary, indent=2, default=str))
+        os.replace(str(tmp_path), str(path))
+
+    def flush(self) -> None:
+        for handle in self._handles.values():
+            handle.flush()
+
+    def shutdown(self) -> None:
+        for handle in self._handles.values():
+            handle.close()
+        self._handles = {}
+
+
+class ColumnarSink(Sink):
+    """Writes turns and tool calls as columnar files partitioned by project/day.
+
+    Layout is hive-style so DuckDB/Polars can prune partitions directly:
+    <root>/<table>/project=<p>/date=<d>/part-<run>-<n>.<ext>, where table is
+    "turns" or "tool_calls". Nested tool input/output is stored as JSON text.
+
+    flush() appends buffered rows to NDJSON staging files under
+    <root>/.staging, so they are on disk before cursors move. A staging file
+    is rolled into one columnar file once it reaches COLUMNAR_ROLL_BYTES or
+    its rows are COLUMNAR_ROLL_SECONDS old, so frequent flushes (every Stop
+    run, watch pass and checkpoint) don't produce a tree of tiny files.
+    Staging is shared between runs under a lock; rows staged by a run that
+    was killed are rolled by a later one.
+    """
+
+    name = "columnar"
+
+    def __init__(self, root: Path, fmt: str = "parquet"):
+        self.root = root
+        self.staging = root / ".staging"
+        self.fmt = "arrow" if fmt in ("arrow", "ipc", "feather") else "parquet"
+        self.run_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self._turns = {}
+        self._tools = {}
+        self._rolls = 0
+
+    def emit(self, record: dict) -> None:
+        key = record_partition(record)
+        self._turns.setdefault(key, []).append({
+            "trace_id": record["trace_id"],
+            "session_id": record["session_id"],
+            "turn_number": record["turn_number"],
+            "timestamp": record.get("timestamp"),
+            "model": record.get("model"),
+            "input": record.get("input"),
+            "output": record.get("output"),
+            "tool_count": len(record["tool_calls"]),
+        })
+        tools = self._tools.setdefault(key, [])
+        for tool_call in record["tool_calls"]:
+            tools.append({
+                "span_id": tool_call["span_id"],
+                "trace_id": record["trace_id"],
+                "session_id": record["session_id"],
+                "turn_number": record["turn_number"],
+                "tool_id": tool_call["id"],
+                "tool_name": tool_call["name"],
+                "is_error": tool_call.get("is_error", False),
+                "input": json.dumps(tool_call["input"], default=str),
+                "output": json.dumps(tool_call["output"], default=str),
+            })
+
+    @contextmanager
+    def _staging_lock(self):
+        self.staging.mkdir(parents=True, exist_ok=True)
+        with open(self.staging / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _stage(self, table: str, partitions: dict) -> None:
+        for (project, day), rows in partitions.items():
+            if not rows:
+                continue
+            directory = self.staging / table / f"project={project}" / f"date={day}"
+            directory.mkdir(parents=True, exist_ok=True)
+            # rows-<epoch>.jsonl: the name records when its oldest row was staged
+            path = next(directory.glob("rows-*.jsonl"), None) or directory / f"rows-{int(time.time())}.jsonl"
+            with open(path, "a") as f:
+                f.write("".join(json.dumps(row, default=str) + "\n" for row in rows))
+
+    def _write_file(self, path: Path, rows: list) -> None:
+        arrow_table = pyarrow.Table.from_pylist(rows)
+        if self.fmt == "arrow":
+            pyarrow.feather.write_feather(arrow_table, str(path))
+        else:
+            pyarrow.parquet.write_table(arrow_table, str(path))
+
+    def _roll(self) -> None:
+        """Convert staging files that are big or old enough into columnar files."""
+        ext = "arrow" if self.fmt == "arrow" else "parquet"
+        now = time.time()
+        for staged in sorted(self.staging.glob("*/project=*/date=*/rows-*.jsonl")):
+            try:
+                started = int(staged.stem.split("-", 1)[1])
+            except ValueError:
+                started = 0
+            if staged.stat().st_size < COLUMNAR_ROLL_BYTES and now - started < COLUMNAR_ROLL_SECONDS:
+                continue
+            rows = []
+            with open(staged) as f:
+                for raw in f:
+                    try:
+                        rows.append(json.loads(raw))
+                    except json.JSONDecodeError:
+                        # A partial row from a run killed mid-write
+                        continue
+            if rows:
+                relative = staged.parent.relative_to(self.staging)
+                path = self.root / relative / f"part-{self.run_id}-{self._rolls}.{ext}"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_name(f".{path.name}.tmp")
+                self._write_file(tmp_path, rows)
+                os.replace(str(tmp_path), str(path))
+                self._rolls += 1
+            # A crash before this unlink re-rolls the rows: dedupe on trace_id/span_id
+            staged.unlink()
+
+    def flush(self) -> None:
+        with self._staging_lock():
+            if self._turns:
+                self._stage("turns", self._turns)
+                self._stage("tool_calls", self._tools)
+                self._turns = {}
+                self._tools = {}
+            self._roll()
+
+    def shutdown(self) -> None:
+        self.flush()
+
+
+class MultiSink(Sink):
+    """Fans records out to several sinks, isolating failures per sink."""
+
+    name = "multi"
+
+    def __init__(self, sinks: list):
+        self.sinks = sinks
+
+    def _each(self, action: str, *args) -> None:
+        for sink in self.sinks:
+            try:
+                getattr(sink, action)(*args)
+            except Exception as e:
+                log("ERROR", f"Sink '{sink.name}' failed during {action}: {e}")
+
+    def emit(self, record: dict) -> None:
+        self._each("emit", record)
+
+    def emit_session(self, summary: dict) -> None:
+        self._each("emit_session", summary)
+
+    def flush(self) -> None:
+        self._each("flush")
+
+    def shutdown(self) -> None:
+        self._each("shutdown")
+
+
+def create_langfuse_client(public_key: str | None = None, secret_key: str | None = None, host: str | None = None) -> Langfuse | None:
+    """Create a Langfuse client, or None on failure.
+
+    Credentials not given fall back to the LANGFUSE_* environment variables.
+    """
+    if Langfuse is None:
+        log("ERROR", "langfuse package not installed. Run: pip install langfuse")
+        return None
+
+    public_key = public_key or os.environ.get("LANGFUSE_PUBLIC_KEY")
+    secret_key = secret_key or os.environ.get("LANGFUSE_SECRET_KEY")
+    host = host or os.environ.get("LANGFUSE_HOST", "http://localhost:3050")
+
+    if not public_key or not secret_key:
+        log("ERROR", "Langfuse API keys not set")
+        return None
+
+    try:
+        return Langfuse(
+            public_key=public_key,
+            secret_key=secret_key,
+            host=host,
+        )
+    except Exception as e:
+        log("ERROR", f"Failed to initialize Langfuse client: {e}")
+        return None
+
+
+def load_routes(path: Path) -> list[dict]:
+    """Load the project routing table, or [] if it is missing or invalid.
+
+    The file holds {"routes": [{"project": "<glob>", "public_key": ...,
+    "secret_key": ..., "host": ...}, ...]}; the first matching glob wins.
+    """
+    if not path.exists():
+        return []
+    try:
+        data = json.loads(path.read_text())
+        routes = data.get("routes") if isinstance(data, dict) else None
+        if not isinstance(routes, list):
+            raise ValueError('expected {"routes": [...]}')
+    except (json.JSONDecodeError, ValueError, IOError) as e:
+        log("WARN", f"Ignoring routing table {path}: {e}")
+        return []
+
+    valid = []
+    for route in routes:
+        if isinstance(route, dict) and route.get("project") and route.get("public_key") and route.get("secret_key"):
+            valid.append(route)
+        else:
+            log("WARN", f"Ignoring route without project/public_key/secret_key in {path}")
+    return valid
+
+
+class RoutingLangfuseSink(Sink):
+    """Sends each project's turns to the Langfuse project its route names.
+
+    Clients are created on first use and pooled by (public_key, host), so
+    sessions sharing credentials share one client for the whole run; flush()
+    and shutdown() run across the pool concurrently. Projects without a
+    matching route use the LANGFUSE_* environment credentials. A project
+    whose client cannot be created is dropped rather than sent elsewhere.
+    """
+
+    name = "langfuse"
+
+    def __init__(self, routes: list[dict]):
+        self.routes = routes
+        self._pool = {}
+        self._by_project = {}
+
+    def route(self, project: str) -> LangfuseSink | None:
+        """Return the pooled sink for a project, creating its client on first use."""
+        if project in self._by_project:
+            return self._by_project[project]
+        route = next((r for r in self.routes if fnmatch.fnmatchcase(project, r["project"])), {})
+        key = (route.get("public_key") or os.environ.get("LANGFUSE_PUBLIC_KEY"), route.get("host") or os.environ.get("LANGFUSE_HOST"))
+        if key not in self._pool:
+            client = create_langfuse_client(route.get("public_key"), route.get("secret_key"), route.get("host"))
+            self._pool[key] = LangfuseSink(client) if client is not None else None
+            if client is not None:
+                debug(f"Created Langfuse client for route '{route.get('project', 'default')}'")
+        sink = self._by_project[project] = self._pool[key]
+        if sink is None:
+            log("ERROR", f"No usable Langfuse client for project '{project}', dropping its turns")
+        return sink
+
+    def emit(self, record: dict) -> None:
+        sink = self.route(record.get("project") or "")
+        if sink is not None:
+            sink.emit(record)
+
+    def emit_session(self, summary: dict) -> None:
+        sink = self.route(summary.get("project") or "")
+        if sink is not None:
+            sink.emit_session(summary)
+
+    def _each(self, action: str) -> None:
+        sinks = {f"{public_key}@{host}": sink for (public_key, host), sink in self._pool.items() if sink is not None}
+        if not sinks:
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(sinks), FLUSH_WORKERS)) as executor:
+            futures = {executor.submit(getattr(sink, action)): client for client, sink in sinks.items()}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    log("ERROR", f"Langfuse client {futures[future]} failed during {action}: {e}")
+
+    def flush(self) -> None:
+        self._each("flush")
+
+    def shutdown(self) -> None:
+        self._each("shutdown")
+
+
+def make_sink(names: list[str]) -> Sink | None:
+    """Build the configured sink(s). Returns None if nothing usable is configured."""
+    sinks = []
+    for name in names:
+        if name == "langfuse":
+            routes = load_routes(ROUTES_FILE)
+            if routes:
+                if Langfuse is None:
+                    log("ERROR", "langfuse package not installed. Run: pip install langfuse")
+                    continue
+                sinks.append(RoutingLangfuseSink(routes))
+                continue
+            client = create_langfuse_client()
+            if client is not None:
+                sinks.append(LangfuseSink(client))
+        elif name == "jsonl":
+            sinks.append(JsonlSink(EXPORT_DIR / "jsonl"))
+        elif name == "columnar":
+            if pyarrow is None:
+                log("ERROR", "columnar sink requires pyarrow. Run: pip install pyarrow")
+                continue
+            sinks.append(ColumnarSink(EXPORT_DIR / "columnar", COLUMNAR_FORMAT))
+        elif name == "null":
+            sinks.append(NullSink())
+        else:
+            log("WARN", f"Unknown sink '{name}' ignored")
+
+    if not sinks:
+        return None
+    if len(sinks) == 1:
+        return sinks[0]
+    return MultiSink(sinks)
+
+
+class TranscriptIndex:
+    """Sidecar random-access index for one transcript, updated incrementally.
+
+    Stored under INDEX_DIR/<project-dir>/<transcript-name>.*:
+    - .lines  byte offset of every line start (native uint64 array, append-only)
+    - .turns  one JSON object per emitted turn: turn number, line, offset, message ids
+    - .json   indexed byte size, line count, last saved turn and the last
+              assistant line
+
+    The tracing hook and `index` lookups (e.g. the ralph-loop Stop hook) can
+    update the same index concurrently, so save() runs under a per-index
+    flock and reconciles with the metadata on disk instead of trusting the
+    copy loaded earlier.
+    """
+
+    def __init__(self, transcript_file: Path):
+        self.transcript_file = transcript_file
+        base = INDEX_DIR / transcript_file.parent.name / transcript_file.name
+        self.lines_path = base.with_name(f"{base.name}.lines")
+        self.turns_path = base.with_name(f"{base.name}.turns")
+        self.meta_path = base.with_name(f"{base.name}.json")
+        self.lock_path = base.with_name(f"{base.name}.lock")
+        self.meta = self._load_meta()
+        self.base_lines = self.meta["lines"]
+        self.new_offsets = array("Q")
+        self.new_turns = []
+
+    def _load_meta(self) -> dict:
+        meta = {"size": 0, "lines": 0, "turns": 0, "last_assistant": None}
+        try:
+            meta.update(json.loads(self.meta_path.read_text()))
+        except (IOError, ValueError):
+            pass
+        return meta
+
+    @contextmanager
+    def _lock(self):
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    @property
+    def line_count(self) -> int:
+        return self.meta["lines"] + len(self.new_offsets)
+
+    def add_line(self, line_index: int, offset: int, end: int, role: str | None = None) -> None:
+        """Record a complete line; lines that are already indexed are ignored."""
+        if line_index != self.line_count:
+            return
+        self.new_offsets.append(offset)
+        self.meta["size"] = end
+        if role == "assistant":
+            self.meta["last_assistant"] = {"line": line_index, "offset": offset}
+
+    def add_turn(self, turn_num: int, turn: Turn) -> None:
+        """Record where an emitted turn starts."""
+        self.new_turns.append({
+            "turn": turn_num,
+            "line": turn.line_index,
+            "offset": turn.offset,
+            "ids": [assistant.msg_id for assistant in turn.assistants if assistant.msg_id],
+        })
+
+    def catch_up(self, until: int | None = None) -> None:
+        """Index complete lines from the indexed size up to `until` (default: EOF).
+
+        Starts over if the transcript shrank, since offsets no longer apply.
+        """
+        if not is_compressed(self.transcript_file) and self.transcript_file.stat().st_size < self.meta["size"]:
+            self.reset()
+        if until is not None and self.meta["size"] >= until:
+            return
+        with open_transcript(self.transcript_file) as f:
+            f.seek(self.meta["size"])
+            offset = self.meta["size"]
+            for raw in f:
+                if not raw.endswith(b"\n") or (until is not None and offset >= until):
+                    break
+                try:
+                    role = message_role(json.loads(raw)) if raw.strip() else None
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    role = None
+                self.add_line(self.line_count, offset, offset + len(raw), role)
+                offset += len(raw)
+
+    def reset(self) -> None:
+        for path in (self.lines_path, self.turns_path, self.meta_path):
+            path.unlink(missing_ok=True)
+        self.meta = {"size": 0, "lines": 0, "turns": 0, "last_assistant": None}
+        self.base_lines = 0
+        self.new_offsets = array("Q")
+        self.new_turns = []
+
+    def save(self) -> None:
+        """Append new offsets and turns, then atomically replace the metadata."""
+        if not self.new_offsets and not self.new_turns:
+            return
+        with self._lock():
+            self._save_locked()
+
+    def _save_locked(self) -> None:
+        if not self.new_offsets and not self.new_turns:
+            return
+        disk = self._load_meta()
+        meta = dict(self.meta)
+        if disk["lines"] >= self.line_count or disk["lines"] < self.base_lines:
+            # Another writer got at least as far, or started over: keep its lines
+            meta.update(size=disk["size"], lines=disk["lines"], last_assistant=disk["last_assistant"])
+            new_offsets = array("Q")
+        else:
+            new_offsets = self.new_offsets[disk["lines"] - self.base_lines:]
+            meta["lines"] = self.line_count
+        new_turns = [entry for entry in self.new_turns if entry["turn"] > disk["turns"]]
+        meta["turns"] = max([disk["turns"]] + [entry["turn"] for entry in new_turns])
+
+        self.meta_path.parent.mkdir(parents=True, exist_ok=True)
+        if new_offsets:
+            with open(self.lines_path, "ab") as f:
+                # Drop entries a killed writer appended without updating the metadata
+                f.truncate(disk["lines"] * new_offsets.itemsize)
+                new_offsets.tofile(f)
+        if new_turns:
+            with open(self.turns_path, "a") as f:
+                f.writelines(json.dumps(entry) + "\n" for entry in new_turns)
+        tmp_path = self.meta_path.with_suffix(f".json.tmp.{os.getpid()}")
+        tmp_path.write_text(json.dumps(meta))
+        os.replace(str(tmp_path), str(self.meta_path))
+        self.meta = meta
+        self.base_lines = meta["lines"]
+        self.new_offsets = array("Q")
+        self.new_turns = []
+
+    def line_offset(self, line_index: int) -> int | None:
+        """Byte offset of a line, read directly from the .lines array."""
+        if not 0 <= line_index < self.meta["lines"]:
+            return None
+        offsets = array("Q")
+        with open(self.lines_path, "rb") as f:
+            f.seek(line_index * offsets.itemsize)
+            offsets.fromfile(f, 1)
+        return offsets[0]
+
+    def turn_entry(self, turn_num: int) -> dict | None:
+        if not self.turns_path.exists():
+            return None
+        with open(self.turns_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["turn"] == turn_num:
+                    return entry
+        return None
+
+    def read_turn(self, turn_num: int) -> list | None:
+        """Return the raw messages of turn N, reading from its indexed offset."""
+        entry = self.turn_entry(turn_num)
+        if entry is None:
+            return None
+        messages = []
+        grouper = TurnGrouper()
+        with open_transcript(self.transcript_file) as f:
+            f.seek(entry["offset"])
+            for raw in f:
+                if not raw.strip():
+                    continue
+                try:
+                    msg = json.loads(raw)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+                # The next user prompt closes this turn
+                if grouper.add(msg) is not None:
+                    break
+                messages.append(msg)
+        return messages
+
+    def last_assistant(self) -> dict | None:
+        """Return the last assistant message, catching the index up first."""
+        with self._lock():
+            if not self.new_offsets and not self.new_turns:
+                self.meta = self._load_meta()
+                self.base_lines = self.meta["lines"]
+            self.catch_up()
+            self._save_locked()
+        last = self.meta.get("last_assistant")
+        if not last:
+            return None
+        with open_transcript(self.transcript_file) as f:
+            f.seek(last["offset"])
+            return json.loads(f.readline())
+
+
+def emit_session_summary(sink: Sink, session_id: str, project_name: str, rollup: dict) -> bool:
+    """Send a session's summary if it gained turns and SUMMARY_INTERVAL has passed.
+
+    Marks the rollup as summarized; the caller persists it with the state.
+    Returns True if a summary was emitted.
+    """
+    if not rollup.get("turns") or rollup.get("summarized_turns") == rollup["turns"]:
+        return False
+    now = datetime.now(timezone.utc)
+    last = parse_timestamp(rollup.get("summarized_at"))
+    if last is not None and (now - last).total_seconds() < SUMMARY_INTERVAL:
+        return False
+    sink.emit_session(build_session_summary(session_id, project_name, rollup))
+    rollup["summarized_at"] = now.isoformat()
+    rollup["summarized_turns"] = rollup["turns"]
+    return True
+
+
+def process_transcript(
+    sink: Sink,
+    session_id: str,
+    transcript_file: Path,
+    state: dict,
+    project_name: str = "",
+    hold_open_turn: bool = False,
+    deadline: float | None = None,
+) -> int:
     """Process a transcript file and create traces for new turns.
 
     This function implements incremental processing:
     - Reads the state file to find where we left off
-    - Processes only new messages since last run
-    - Groups messages into turns (user -> assistant -> tools)
-    - Creates a Langfuse trace for each complete turn
+    - Seeks to the saved byte offset and reads only appended lines
+    - Groups messages into turns (user -> assistant -> tools) as they are read
+    - Emits a turn record to the sink for each complete turn
     - Updates state with new position
 
+    With hold_open_turn (watch mode), the trailing turn is only emitted once
+    its last assistant message has a final stop_reason (Turn.is_complete);
+    otherwise the cursor is left at the turn's user message so it is re-read next time.
+    A trailing prompt with no assistant lines yet is always held this way, so
+    turn numbers match what replay assigns.
+
+    A compressed archive that fails to decompress part-way is recorded in
+    state with its size and skipped until it changes; the read error is
+    re-raised for the caller to log.
+
+    Each emitted turn is folded into the session's rollup in state, and a
+    session summary is sent at most every SUMMARY_INTERVAL seconds, also
+    when no new lines arrived so the last turns of a session get counted.
+
+    The sink is flushed before every cursor save, and every CHECKPOINT_TURNS
+    emitted turns the cursor is saved mid-file, so a killed run neither
+    loses buffered records nor loses all of its progress. Once `deadline` (a
+    time.monotonic() value) passes, processing stops after the current turn
+    and the cursor is left at the next one.
+
     Returns: Number of new turns processed
     """
     # Load session state
     session_state = state.get(session_id, {})
     last_line = session_state.get("last_line", 0)
+    last_offset = session_state.get("last_offset")
     turn_count = session_state.get("turn_count", 0)
+    rollup = session_state.get("rollup", {})
 
-    # Read transcript file
-    lines = transcript_file.read_text().strip().split("\n")
-    total_lines = len(lines)
-
-    # Check if there are new lines to process
-    if last_line >= total_lines:
-        debug(f"No new lines to process (last: {last_line}, total: {total_lines})")
+    # Compressed archives don't grow: skip them once fully read at this size
+    file_size = transcript_file.stat().st_size
+    if is_compressed(transcript_file):
+        unchanged = session_state.get("failed_size") == file_size or (
+            last_offset is not None and session_state.get("file_size") == file_size
+        )
+        if unchanged:
+            debug(f"Archive already processed or unreadable (size: {file_size})")
+    else:
+        unchanged = last_offset is not None and last_offset >= file_size
+        if unchanged:
+            debug(f"No new bytes to process (offset: {last_offset})")
+    if unchanged:
+        if emit_session_summary(sink, session_id, project_name, rollup):
+            sink.flush()
+            save_state(state)
         return 0
 
-    # Parse new messages, tracking parse failures
-    new_messages = []
+    # Read only the appended part of the transcript, tracking parse failures
+    index = TranscriptIndex(transcript_file)
+    grouper = TurnGrouper()
+    turns = 0
+    message_count = 0
     bad_line_count = 0
-    last_valid_line = last_line
-    for i in range(last_line, total_lines):
-        try:
-            msg = json.loads(lines[i])
-            new_messages.append(msg)
-            last_valid_line = i + 1
-        except json.JSONDecodeError as e:
-            bad_line_count += 1
-            # If it's the very last line, it may be a partial write — don't advance past it
-            if i == total_lines - 1:
-                log("WARN", f"Skipping incomplete tail line {i + 1} in {transcript_file.name} (may be partial write)")
-                last_valid_line = i  # Don't advance past this line
+
+    def save_cursor(line: int, offset: int, read_to_end: bool = False) -> None:
+        state[session_id] = {
+            "last_line": line,
+            "last_offset": offset,
+            "turn_count": turn_count + turns,
+            "bad_line_count": session_state.get("bad_line_count", 0) + bad_line_count,
+            "rollup": rollup,
+            "updated": datetime.now(timezone.utc).isoformat(),
+        }
+        if read_to_end:
+            state[session_id]["file_size"] = file_size
+        save_state(state)
+
+    stopped_at_deadline = False
+    try:
+        with open_transcript(transcript_file) as f:
+            if last_offset is None:
+                # Cursor saved by an older version as a line count: skip those lines once
+                for _ in range(last_line):
+                    if not f.readline():
+                        break
+                last_offset = f.tell()
             else:
-                log("WARN", f"Malformed JSONL at line {i + 1} in {transcript_file.name}: {e}")
+                f.seek(last_offset)
+
+            # An archive's index starts empty under its new name; catching it up
+            # would decompress the prefix a second time just to seek past it
+            if not is_compressed(transcript_file):
+                try:
+                    index.catch_up(last_offset)
+                except (IOError, OSError) as e:
+                    debug(f"Index catch-up failed for {transcript_file.name}: {e}")
+
+            offset, line_no = last_offset, last_line
+            cursor_offset, cursor_line = last_offset, last_line
+            for raw in f:
+                start = offset
+                offset += len(raw)
+                line_no += 1
+                if not raw.strip():
+                    index.add_line(line_no - 1, start, offset)
+                    cursor_offset, cursor_line = offset, line_no
+                    continue
+                try:
+                    msg = json.loads(raw)
+                except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                    # An unterminated last line may be a partial write — don't advance past it
+                    if not raw.endswith(b"\n"):
+                        log("WARN", f"Skipping incomplete tail line {line_no} in {transcript_file.name} (may be partial write)")
+                        break
+                    bad_line_count += 1
+                    log("WARN", f"Malformed JSONL at line {line_no} in {transcript_file.name}: {e}")
+                    index.add_line(line_no - 1, start, offset)
+                    cursor_offset, cursor_line = offset, line_no
+                    continue
+                message_count += 1
+                cursor_offset, cursor_line = offset, line_no
+                if raw.endswith(b"\n"):
+                    index.add_line(line_no - 1, start, offset, message_role(msg))
+
+                finished = grouper.add(msg, line_no - 1, start)
+                if finished is not None and finished.assistants:
+                    turns += 1
+                    record = build_turn_record(session_id, turn_count + turns, finished, project_name)
+                    sink.emit(record)
+                    update_rollup(rollup, record)
+                    index.add_turn(turn_count + turns, finished)
+
+                    # The prompt that closed this turn is where the next run resumes
+                    if deadline is not None and time.monotonic() >= deadline:
+                        cursor_line, cursor_offset = grouper.current.line_index, grouper.current.offset
+                        stopped_at_deadline = True
+                        break
+                    if CHECKPOINT_TURNS > 0 and turns % CHECKPOINT_TURNS == 0:
+                        emit_session_summary(sink, session_id, project_name, rollup)
+                        sink.flush()
+                        save_cursor(grouper.current.line_index, grouper.current.offset)
+                        debug(f"Checkpoint after {turns} turn(s) at line {grouper.current.line_index + 1}")
+    except TRANSCRIPT_READ_ERRORS:
+        if is_compressed(transcript_file):
+            # Turns read before the damage were emitted; skip the archive until
+            # it changes rather than emitting them again on every run
+            sink.flush()
+            state[session_id] = {**state.get(session_id, {}), "rollup": rollup, "failed_size": file_size}
+            save_state(state)
+        raise
 
     if bad_line_count > 0:
-        log("INFO", f"Session {session_id}: {bad_line_count} malformed line(s) out of {total_lines - last_line} new")
-
-    if not new_messages:
+        log("INFO", f"Session {session_id}: {bad_line_count} malformed line(s) out of {cursor_line - last_line} new")
+
+    if cursor_offset == last_offset:
+        emitted_summary = emit_session_summary(sink, session_id, project_name, rollup)
+        if emitted_summary:
+            sink.flush()
+        if is_compressed(transcript_file):
+            save_cursor(cursor_line, cursor_offset, read_to_end=True)
+        elif emitted_summary:
+            save_state(state)
         return 0
 
-    debug(f"Processing {len(new_messages)} new messages")
+    debug(f"Processed {message_count} new messages")
+
+    trailing = grouper.current
+    if stopped_at_deadline:
+        log("INFO", f"Session {session_id}: time budget reached, resuming at line {cursor_line + 1} next run")
+    elif hold_open_turn and trailing is not None and not trailing.is_complete:
+        # Turn still in progress: resume from its user message next time
+        cursor_line, cursor_offset = trailing.line_index, trailing.offset
+        debug(f"Holding open turn at line {cursor_line + 1}")
+    elif trailing is not None and not trailing.assistants:
+        # Prompt not answered yet: its assistant lines would be orphaned past the cursor
+        cursor_line, cursor_offset = trailing.line_index, trailing.offset
+        debug(f"Holding unanswered prompt at line {cursor_line + 1}")
+    elif trailing is not None:
+        # Create trace for final turn if complete
+        turns += 1
+        record = build_turn_record(session_id, turn_count + turns, trailing, project_name)
+        sink.emit(record)
+        update_rollup(rollup, record)
+        index.add_turn(turn_count + turns, trailing)
+
+    emitted_summary = emit_session_summary(sink, session_id, project_name, rollup)
 
-    # Group messages into turns
-    # A turn is: user message -> assistant message(s) -> tool results
-    turns = 0
-    current_user = None
-    current_assistants = []
-    current_assistant_parts = []
-    current_msg_id = None
-    current_tool_results = []
+    try:
+        index.save()
+    except (IOError, OSError) as e:
+        log("WARN", f"Failed to update index for {transcript_file.name}: {e}")
 
-    for msg in new_messages:
-        role = msg.get("type") or (msg.get("message", {}).get("role"))
+    # Emitted records must be durable before the cursor moves past them
+    if turns or emitted_summary:
+        sink.flush()
 
-        if role == "user":
-            # Check if this is a tool result (user messages containing tool_result blocks)
-            if is_tool_result(msg):
-                current_tool_results.append(msg)
+    # Update state atomically
+    save_cursor(cursor_line, cursor_offset, read_to_end=not stopped_at_deadline)
+
+    return turns
+
+
+@contextmanager
+def run_lock(deadline: float | None = None):
+    """Serialize transcript processing between the Stop hook and watch mode.
+
+    Holds an exclusive flock on RUN_LOCK_FILE so two runs never emit the same
+    turns from a stale cursor. Callers should reload state after acquiring it.
+    With a deadline (a time.monotonic() value), waits for the lock only until
+    then and raises TimeoutError, so a time-budgeted run never blocks behind
+    watch mode.
+    """
+    RUN_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(RUN_LOCK_FILE, "w") as lock:
+        if deadline is None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        else:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError("run lock held by another run")
+                    time.sleep(min(RUN_LOCK_POLL, max(deadline - time.monotonic(), 0)))
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class InotifyWatcher:
+    """Minimal inotify binding (via ctypes) for the projects directory tree.
+
+    Watches PROJECTS_DIR for new project directories and every project
+    directory for created/modified transcripts. Raises OSError if inotify
+    is unavailable so the caller can fall back to polling. When the kernel
+    queue overflows or a new directory cannot be watched, read_changes()
+    rescans the tree and reports every transcript instead.
+    """
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    FILE_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, root: Path):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify not supported on this platform")
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.dirs = {}
+        self.add_dir(root)
+        for project_dir in root.iterdir():
+            if project_dir.is_dir():
+                self.add_dir(project_dir)
+
+    def add_dir(self, path: Path) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)), self.FILE_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.dirs[wd] = path
+
+    def rescan(self) -> set[Path]:
+        """Watch any project directory missed so far and return every transcript."""
+        watched = set(self.dirs.values())
+        changed = set()
+        for project_dir in self.root.iterdir():
+            if not project_dir.is_dir():
+                continue
+            try:
+                if project_dir not in watched:
+                    self.add_dir(project_dir)
+            except OSError as e:
+                debug(f"Could not watch {project_dir}: {e}")
+            try:
+                changed.update(path for path in project_dir.iterdir() if is_transcript(path))
+            except OSError as e:
+                debug(f"Skipping {project_dir} during rescan: {e}")
+        return changed
+
+    def read_changes(self, timeout: float | None) -> set[Path]:
+        """Wait up to timeout seconds and return the set of touched transcripts."""
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        pos = 0
+        needs_rescan = False
+        while pos + self.EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            name = data[pos:pos + name_len].rstrip(b"\0").decode(errors="replace")
+            pos += name_len
+            if mask & self.IN_Q_OVERFLOW:
+                log("WARN", "inotify queue overflowed, rescanning transcripts")
+                needs_rescan = True
+                continue
+            parent = self.dirs.get(wd)
+            if parent is None or not name:
+                continue
+            path = parent / name
+            if mask & self.IN_ISDIR:
+                if parent == self.root:
+                    try:
+                        self.add_dir(path)
+                        changed.update(path.glob("*.jsonl"))
+                    except OSError as e:
+                        # e.g. the directory was removed right after it was created
+                        debug(f"Could not watch {path}: {e}")
+                        needs_rescan = True
+            elif name.endswith(".jsonl"):
+                changed.add(path)
+        return changed | self.rescan() if needs_rescan else changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback watcher that compares transcript sizes/mtimes every interval."""
+
+    def __init__(self, root: Path, interval: float):
+        self.root = root
+        self.interval = interval
+        self.seen = self._snapshot()
+
+    def _snapshot(self) -> dict:
+        snapshot = {}
+        for path in self.root.glob("*/*.jsonl"):
+            try:
+                st = path.stat()
+            except OSError:
                 continue
+            snapshot[path] = (st.st_size, st.st_mtime)
+        return snapshot
 
-            # Merge any pending assistant parts
-            if current_msg_id and current_assistant_parts:
-                merged = merge_assistant_parts(current_assistant_parts)
-                current_assistants.append(merged)
-                current_assistant_parts = []
-                current_msg_id = None
-
-            # If we have a complete turn, create a trace
-            if current_user and current_assistants:
-                turns += 1
-                turn_num = turn_count + turns
-                create_trace(langfuse, session_id, turn_num, current_user, current_assistants, current_tool_results, project_name)
-
-            # Start new turn
-            current_user = msg
-            current_assistants = []
-            current_assistant_parts = []
-            current_msg_id = None
-            current_tool_results = []
-
-        elif role == "assistant":
-            # Extract message ID to detect multi-part messages
-            msg_id = None
-            if isinstance(msg, dict) and "message" in msg:
-                msg_id = msg["message"].get("id")
-
-            if not msg_id:
-                # No ID means single-part message
-                current_assistant_parts.append(msg)
-            elif msg_id == current_msg_id:
-                # Same ID means continuation of current message
-                current_assistant_parts.append(msg)
-            else:
-                # New ID means new assistant message
-                if current_msg_id and current_assistant_parts:
-                    merged = merge_assistant_parts(current_assistant_parts)
-                    current_assistants.append(merged)
+    def read_changes(self, timeout: float | None) -> set[Path]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        current = self._snapshot()
+        changed = {path for path, sig in current.items() if self.seen.get(path) != sig}
+        self.seen = current
+        return changed
 
-                current_msg_id = msg_id
-                current_assistant_parts = [msg]
+    def close(self) -> None:
+        pass
 
-    # Handle final assistant message
-    if current_msg_id and current_assistant_parts:
-        merged = merge_assistant_parts(current_assistant_parts)
-        current_assistants.append(merged)
 
-    # Create trace for final turn if complete
-    if current_user and current_assistants:
-        turns += 1
-        turn_num = turn_count + turns
-        create_trace(langfuse, session_id, turn_num, current_user, current_assistants, current_tool_results, project_name)
+def watch() -> None:
+    """Tail transcripts continuously and emit turns as soon as they complete.
 
-    # Update state atomically
-    state[session_id] = {
-        "last_line": last_valid_line,
-        "turn_count": turn_count + turns,
-        "bad_line_count": session_state.get("bad_line_count", 0) + bad_line_count,
-        "updated": datetime.now(timezone.utc).isoformat(),
-    }
-    save_state(state)
+    Uses inotify when available, otherwise polls. Writes are debounced: after
+    the first change, events keep being collected until WATCH_DEBOUNCE seconds
+    pass without new ones (capped at WATCH_MAX_DELAY), then each touched
+    transcript is read once from its saved byte offset.
+    """
+    sink = make_sink(SINKS)
+    if sink is None:
+        log("ERROR", f"No usable export sink configured (CC_LANGFUSE_SINKS={','.join(SINKS)})")
+        sys.exit(0)
+
+    PROJECTS_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        watcher = InotifyWatcher(PROJECTS_DIR)
+        log("INFO", f"Watching {PROJECTS_DIR} via inotify")
+    except OSError as e:
+        watcher = PollingWatcher(PROJECTS_DIR, WATCH_POLL_INTERVAL)
+        log("INFO", f"inotify unavailable ({e}), polling {PROJECTS_DIR} every {WATCH_POLL_INTERVAL}s")
+
+    # Pick up anything written while the watcher was not running
+    pending = {path for _, path, _ in find_all_transcripts()}
+    try:
+        while True:
+            if not pending:
+                pending = watcher.read_changes(None)
+                if not pending:
+                    continue
+                # Debounce: a burst of writes results in a single read per file
+                burst_start = time.monotonic()
+                while time.monotonic() - burst_start < WATCH_MAX_DELAY:
+                    more = watcher.read_changes(WATCH_DEBOUNCE)
+                    if not more:
+                        break
+                    pending |= more
+
+            with run_lock():
+                state = load_state()
+                total_turns = 0
+                for transcript_file in sorted(pending):
+                    try:
+                        session_id, _, project_name = describe_transcript(transcript_file)
+                        total_turns += process_transcript(sink, session_id, transcript_file, state, project_name,
+                                                          hold_open_turn=True)
+                    except (json.JSONDecodeError, *TRANSCRIPT_READ_ERRORS) as e:
+                        debug(f"Skipping unreadable transcript {transcript_file}: {e}")
+                    except Exception as e:
+                        log("ERROR", f"Failed to process {transcript_file.name}: {e}")
+                if total_turns:
+                    sink.flush()
+                    log("INFO", f"Watch: emitted {total_turns} turn(s) from {len(pending)} transcript(s)")
+            pending = set()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        sink.shutdown()
+
+
+def start_profiling() -> cProfile.Profile | None:
+    """Start cProfile and tracemalloc if CC_LANGFUSE_PROFILE is set.
+
+    "always" keeps a capture for every run; "slow" profiles every run but
+    only keeps captures for runs exceeding CC_LANGFUSE_PROFILE_THRESHOLD.
+    """
+    if PROFILE_MODE not in ("always", "slow"):
+        return None
+    try:
+        tracemalloc.start(PROFILE_TRACE_FRAMES)
+        profiler = cProfile.Profile()
+        profiler.enable()
+    except (ValueError, RuntimeError) as e:
+        # e.g. another profiler already active: trace without profiling
+        tracemalloc.stop()
+        log("WARN", f"Profiling disabled: {e}")
+        return None
+    return profiler
+
+
+def finish_profiling(profiler: cProfile.Profile | None, duration: float) -> None:
+    """Stop profiling and write the capture to PROFILE_DIR when it should be kept.
+
+    Writes <stamp>.pstats (load with `python -m pstats`) and <stamp>.txt with
+    the top functions by cumulative time and the top allocation sites.
+    """
+    if profiler is None:
+        return
+    profiler.disable()
+    try:
+        if PROFILE_MODE == "slow" and duration < PROFILE_THRESHOLD:
+            return
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
+        profiler.dump_stats(str(PROFILE_DIR / f"{stamp}.pstats"))
+
+        report = io.StringIO()
+        report.write(f"Run duration: {duration:.1f}s\n")
+        report.write(f"Traced memory: current {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB\n\n")
+        report.write("=== Top functions by cumulative time ===\n")
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        report.write("=== Top allocation sites ===\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+            report.write(f"{stat}\n")
+        (PROFILE_DIR / f"{stamp}.txt").write_text(report.getvalue())
+        log("INFO", f"Profile for {duration:.1f}s run written to {PROFILE_DIR / stamp}.{{pstats,txt}}")
+
+        # Keep only the most recent captures
+        for old in sorted(PROFILE_DIR.glob("*.pstats"))[:-PROFILE_KEEP]:
+            old.unlink(missing_ok=True)
+            old.with_suffix(".txt").unlink(missing_ok=True)
+    except (IOError, OSError) as e:
+        log("WARN", f"Failed to write profile: {e}")
+    finally:
+        tracemalloc.stop()
+
+
+def read_hook_input() -> dict:
+    """Read the Stop hook's JSON payload (session_id, transcript_path) from stdin."""
+    if sys.stdin is None or sys.stdin.isatty():
+        return {}
+    try:
+        # Don't block when run by hand/cron with an open but silent stdin
+        ready, _, _ = select.select([sys.stdin], [], [], HOOK_INPUT_TIMEOUT)
+        if not ready:
+            return {}
+        data = json.loads(sys.stdin.read() or "{}")
+    except (json.JSONDecodeError, OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
 
-    return turns
+
+def prioritize_transcripts(transcripts: list, hook_input: dict) -> list:
+    """Move the session that fired Stop to the front, keeping the rest in order."""
+    session_id = hook_input.get("session_id")
+    transcript_path = hook_input.get("transcript_path")
+    fired = [
+        t for t in transcripts
+        if (session_id and t[0] == session_id) or (transcript_path and str(t[1]) == transcript_path)
+    ]
+    return fired + [t for t in transcripts if t not in fired]
+
+
+def index_command(args: argparse.Namespace) -> int:
+    """Serve `index` subcommands: print a line, a turn or the last assistant message."""
+    index = TranscriptIndex(args.transcript.resolve())
+    try:
+        if args.index_command == "line":
+            offset = index.line_offset(args.line - 1)
+            if offset is None:
+                print(f"Line {args.line} not indexed for {args.transcript}", file=sys.stderr)
+                return 1
+            with open_transcript(index.transcript_file) as f:
+                f.seek(offset)
+                sys.stdout.write(f.readline().decode(errors="replace"))
+            return 0
+        if args.index_command == "turn":
+            messages = index.read_turn(args.turn)
+            if messages is None:
+                print(f"Turn {args.turn} not indexed for {args.transcript}", file=sys.stderr)
+                return 1
+            for msg in messages:
+                print(json.dumps(msg))
+            return 0
+
+        msg = index.last_assistant()
+    except (IOError, OSError, json.JSONDecodeError) as e:
+        print(f"Index lookup failed: {e}", file=sys.stderr)
+        return 1
+    if msg is None:
+        print(f"No assistant message in {args.transcript}", file=sys.stderr)
+        return 1
+    if args.text:
+        print("\n".join(text_parts(message_content(msg))))
+    else:
+        print(json.dumps(msg))
+    return 0
+
+
+def parse_turn_range(value: str) -> tuple[int, int]:
+    """Parse "N" or "A-B" (either side may be omitted) into an inclusive range."""
+    first, sep, last = value.partition("-")
+    try:
+        start = int(first) if first else 1
+        end = (int(last) if last else sys.maxsize) if sep else start
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid turn range: {value}")
+    if start < 1 or end < start:
+        raise argparse.ArgumentTypeError(f"invalid turn range: {value}")
+    return start, end
+
+
+def replay(sink: Sink, session_id: str, first: int = 1, last: int = sys.maxsize) -> int:
+    """Re-export turns first..last of a session without touching cursors.
+
+    Turns are numbered exactly as incremental processing numbers them, and
+    their ids are deterministic, so replaying overwrites rather than
+    duplicates. Seeks straight to the first turn when the index knows it.
+
+    Returns: Number of turns emitted
+    """
+    match = next(
+        ((sid, path, proj) for sid, path, proj in find_all_transcripts() if session_id in (sid, transcript_stem(path))),
+        None,
+    )
+    if match is None:
+        log("ERROR", f"Replay: no transcript found for session {session_id}")
+        return 0
+    session_id, transcript_file, project_name = match
+
+    entry = TranscriptIndex(transcript_file).turn_entry(first) if first > 1 else None
+    offset, turn_num = (entry["offset"], first - 1) if entry else (0, 0)
+
+    emitted = 0
+    grouper = TurnGrouper()
+    with open_transcript(transcript_file) as f:
+        f.seek(offset)
+        for raw in f:
+            if not raw.strip():
+                continue
+            try:
+                msg = json.loads(raw)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue
+            finished = grouper.add(msg)
+            if finished is not None and finished.assistants:
+                turn_num += 1
+                if turn_num >= first:
+                    sink.emit(build_turn_record(session_id, turn_num, finished, project_name))
+                    emitted += 1
+                if turn_num >= last:
+                    return emitted
+
+    trailing = grouper.current
+    if trailing is not None and trailing.assistants and first <= turn_num + 1 <= last:
+        sink.emit(build_turn_record(session_id, turn_num + 1, trailing, project_name))
+        emitted += 1
+    return emitted
+
+
+def replay_command(args: argparse.Namespace) -> int:
+    """Serve the `replay` subcommand."""
+    names = [s.strip().lower() for s in args.sinks.split(",") if s.strip()] if args.sinks else SINKS
+    sink = make_sink(names)
+    if sink is None:
+        print(f"No usable export sink configured ({','.join(names)})", file=sys.stderr)
+        return 1
+    first, last = args.turns
+    try:
+        emitted = replay(sink, args.session_id, first, last)
+        sink.flush()
+    finally:
+        sink.shutdown()
+    log("INFO", f"Replay: emitted {emitted} turn(s) for session {args.session_id}")
+    print(f"Replayed {emitted} turn(s)")
+    return 0 if emitted else 1
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    """Parse CLI arguments. With no command, run as the Stop hook."""
+    parser = argparse.ArgumentParser(description="Trace Claude Code transcripts to Langfuse and other sinks.")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("watch", help="tail transcripts and emit turns as they complete")
+
+    index_parser = commands.add_parser("index", help="random access into a transcript via its sidecar index")
+    index_commands = index_parser.add_subparsers(dest="index_command", required=True)
+    line_parser = index_commands.add_parser("line", help="print line N (1-based) by seeking to its indexed offset")
+    line_parser.add_argument("transcript", type=Path)
+    line_parser.add_argument("line", type=int)
+    turn_parser = index_commands.add_parser("turn", help="print the messages of turn N as JSONL")
+    turn_parser.add_argument("transcript", type=Path)
+    turn_parser.add_argument("turn", type=int)
+    last_parser = index_commands.add_parser("last-assistant", help="print the last assistant message")
+    last_parser.add_argument("transcript", type=Path)
+    last_parser.add_argument("--text", action="store_true", help="print only its text content")
+
+    replay_parser = commands.add_parser("replay", help="re-export a session (idempotent: trace ids are deterministic)")
+    replay_parser.add_argument("session_id", help="session id or transcript file stem")
+    replay_parser.add_argument("--turns", type=parse_turn_range, default=(1, sys.maxsize),
+                               help='turn number or inclusive range, e.g. "5" or "3-7"')
+    replay_parser.add_argument("--sinks", help="comma-separated sinks (default: CC_LANGFUSE_SINKS)")
+
+    return parser.parse_args(argv)
 
 
 def main():
     """Main entry point for the hook."""
+    args = parse_args(sys.argv[1:])
+    for warning in CONFIG_WARNINGS:
+        log("WARN", warning)
+    if args.command == "watch":
+        watch()
+        sys.exit(0)
+    if args.command == "index":
+        sys.exit(index_command(args))
+    if args.command == "replay":
+        sys.exit(replay_command(args))
+
     script_start = datetime.now()
     debug("Hook started")
 
@@ -541,33 +2242,20 @@ def main():
         debug("Tracing disabled (TRACE_TO_LANGFUSE != true)")
         sys.exit(0)
 
-    # Get Langfuse credentials from environment
-    public_key = os.environ.get("LANGFUSE_PUBLIC_KEY")
-    secret_key = os.environ.get("LANGFUSE_SECRET_KEY")
-    host = os.environ.get("LANGFUSE_HOST", "http://localhost:3050")
-
-    if not public_key or not secret_key:
-        log("ERROR", "Langfuse API keys not set")
-        sys.exit(0)
-
-    # Initialize Langfuse client
-    try:
-        langfuse = Langfuse(
-            public_key=public_key,
-            secret_key=secret_key,
-            host=host,
-        )
-    except Exception as e:
-        log("ERROR", f"Failed to initialize Langfuse client: {e}")
+    # Build export sink(s); langfuse needs credentials, file sinks do not
+    sink = make_sink(SINKS)
+    if sink is None:
+        log("ERROR", f"No usable export sink configured (CC_LANGFUSE_SINKS={','.join(SINKS)})")
         sys.exit(0)
 
-    # Load state (with corruption recovery)
-    state = load_state()
+    profiler = start_profiling()
+    deadline = time.monotonic() + TIME_BUDGET if TIME_BUDGET > 0 else None
 
-    # Find all active transcripts
-    transcripts = find_all_transcripts()
+    # Find all active transcripts: the session that fired Stop, then most recently modified
+    transcripts = prioritize_transcripts(find_all_transcripts(), read_hook_input())
     if not transcripts:
         debug("No transcript files found")
+        sink.shutdown()
         sys.exit(0)
 
     log("INFO", f"Found {len(transcripts)} transcript(s) to process")
@@ -575,28 +2263,44 @@ def main():
     # Process all transcripts incrementally
     total_turns = 0
     try:
-        for session_id, transcript_file, project_name in transcripts:
-            log("INFO", f"Processing session {session_id} ({project_name}) from {transcript_file.name}")
-            turns = process_transcript(langfuse, session_id, transcript_file, state, project_name)
-            total_turns += turns
-            if turns > 0:
-                session_state = state.get(session_id, {})
-                log("INFO", f"  Emitted {turns} turn(s), cursor at line {session_state.get('last_line', '?')}, total turns: {session_state.get('turn_count', '?')}")
-
-        langfuse.flush()
+        # Load state (with corruption recovery) only once no other run can move cursors
+        with run_lock(deadline):
+            state = load_state()
+            for position, (session_id, transcript_file, project_name) in enumerate(transcripts):
+                if deadline is not None and time.monotonic() >= deadline:
+                    log("INFO", f"Time budget of {TIME_BUDGET:.0f}s reached, deferring {len(transcripts) - position} session(s) to next run")
+                    break
+                log("INFO", f"Processing session {session_id} ({project_name}) from {transcript_file.name}")
+                try:
+                    turns = process_transcript(sink, session_id, transcript_file, state, project_name, deadline=deadline)
+                except TRANSCRIPT_READ_ERRORS as e:
+                    # e.g. a truncated or corrupt archive: skip it rather than blocking every run
+                    log("WARN", f"Failed to read {transcript_file.name}: {e}")
+                    continue
+                total_turns += turns
+                if turns > 0:
+                    session_state = state.get(session_id, {})
+                    log("INFO", f"  Emitted {turns} turn(s), cursor at line {session_state.get('last_line', '?')}, total turns: {session_state.get('turn_count', '?')}")
+
+        sink.flush()
         duration = (datetime.now() - script_start).total_seconds()
         log("INFO", f"Done: {total_turns} turn(s) across {len(transcripts)} session(s) in {duration:.1f}s")
 
         # Warn if hook is taking too long
-        if duration > 180:
+        if duration > SLOW_RUN_SECONDS:
             log("WARN", f"Hook took {duration:.1f}s (>3min), consider optimizing")
+            if not PROFILE_MODE:
+                log("INFO", "Set CC_LANGFUSE_PROFILE=slow to capture a profile of slow runs")
 
+    except TimeoutError:
+        log("INFO", f"Time budget of {TIME_BUDGET:.0f}s spent waiting for another run (e.g. watch mode), deferring to next run")
     except Exception as e:
         log("ERROR", f"Failed to process transcripts: {e}")
         import traceback
         debug(traceback.format_exc())
     finally:
-        langfuse.shutdown()
+        sink.shutdown()
+        finish_profiling(profiler, (datetime.now() - script_start).total_seconds())
 
     sys.exit(0)
 
@@ -67,8 +67,15 @@ if [[ ! -f "$TRANSCRIPT_PATH" ]]; then
 fi
 
 # Read last assistant message from transcript (JSONL format - one JSON per line)
-# First check if there are any assistant messages
-if ! grep -q '"role":"assistant"' "$TRANSCRIPT_PATH"; then
+# Scan backwards and stop at the first match rather than reading the whole file;
+# tac is GNU-only, so fall back to a forward scan elsewhere. || true: under
+# pipefail, tac exiting on SIGPIPE after grep -m1 stops is not an error
+if command -v tac >/dev/null 2>&1; then
+  LAST_LINE=$(tac "$TRANSCRIPT_PATH" | grep -m1 '"role":"assistant"' || true)
+else
+  LAST_LINE=$(grep '"role":"assistant"' "$TRANSCRIPT_PATH" | tail -1 || true)
+fi
+if [[ -z "$LAST_LINE" ]]; then
   echo "⚠️  Ralph loop: No assistant messages found in transcript" >&2
   echo "   Transcript: $TRANSCRIPT_PATH" >&2
   echo "   This is unusual and may indicate a transcript format issue" >&2
@@ -77,15 +84,6 @@ if ! grep -q '"role":"assistant"' "$TRANSCRIPT_PATH"; then
   exit 0
 fi
 
-# Extract last assistant message with explicit error handling
-LAST_LINE=$(grep '"role":"assistant"' "$TRANSCRIPT_PATH" | tail -1)
-if [[ -z "$LAST_LINE" ]]; then
-  echo "⚠️  Ralph loop: Failed to extract last assistant message" >&2
-  echo "   Ralph loop is stopping." >&2
-  rm "$RALPH_STATE_FILE"
-  exit 0
-fi
-
 # Parse JSON with error handling
 LAST_OUTPUT=$(echo "$LAST_LINE" | jq -r '
   .message.content |
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: per-line turn grouping in langfuse_hook.py
+
+Compares the original pipeline (role lookup, is_tool_result,
+merge_assistant_parts, then get_tool_calls, get_text_content and a scan of
+every tool result per tool call) with TurnGrouper, which scans each line's
+content once. The original helpers are loaded from the repository's first
+commit, or from the git revision given as the only argument. Sanitization
+and sink output are excluded. Run directly:
+
+    python3 infra/tests/bench_classifier.py [REV]
+"""
+import subprocess
+import sys
+import timeit
+import types
+from pathlib import Path
+from unittest.mock import MagicMock
+
+# Mock the langfuse module before importing the hook
+sys.modules['langfuse'] = MagicMock()
+
+# Add hooks directory to path
+HOOKS_DIR = Path(__file__).parent.parent.parent / 'agent-config' / 'plugins' / 'nmc-langfuse-tracing' / 'hooks'
+sys.path.insert(0, str(HOOKS_DIR))
+
+from langfuse_hook import TurnGrouper
+
+# Short, typical and long agentic turns; the original result lookup scans
+# every earlier tool_result for each tool call, so it grows with turn size
+TOOL_STEPS = (6, 25, 100)
+
+
+def load_baseline(rev: str | None) -> types.ModuleType:
+    """Import langfuse_hook.py as it was at `rev` (default: the first commit)."""
+    repo = HOOKS_DIR.parent.parent.parent.parent
+    git = ["git", "-C", str(repo)]
+    if rev is None:
+        rev = subprocess.run(git + ["rev-list", "--max-parents=0", "HEAD"], capture_output=True, text=True, check=True).stdout.split()[0]
+    path = (HOOKS_DIR / "langfuse_hook.py").relative_to(repo).as_posix()
+    source = subprocess.run(git + ["show", f"{rev}:{path}"], capture_output=True, text=True, check=True).stdout
+    module = types.ModuleType("baseline_hook")
+    exec(compile(source, f"{rev}:{path}", "exec"), module.__dict__)
+    return module
+
+
+def make_turn(tool_steps: int) -> list:
+    """One prompt, then per step an assistant text part, a tool_use part and its result."""
+    lines = [{"type": "user", "message": {"role": "user", "content": "Refactor the parser and run the tests"}}]
+    for step in range(tool_steps):
+        msg_id = f"msg_{step}"
+        lines.append({"type": "assistant", "message": {"id": msg_id, "model": "claude", "content": [
+            {"type": "text", "text": f"Step {step}: checking the next file."}]}})
+        lines.append({"type": "assistant", "message": {"id": msg_id, "model": "claude", "content": [
+            {"type": "tool_use", "id": f"toolu_{step}", "name": "Read", "input": {"file_path": f"/src/m{step}.py"}}]}})
+        lines.append({"type": "user", "message": {"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{step}", "content": "def parse(): ..."}]}})
+    return lines
+
+
+def original_pipeline(hook: types.ModuleType, lines: list) -> list:
+    """Grouping (process_transcript) and extraction (create_trace) of the original hook."""
+    user, assistants, parts, current_id, results = None, [], [], None, []
+    for msg in lines:
+        role = msg.get("type") or (msg.get("message", {}).get("role"))
+        if role == "user":
+            if hook.is_tool_result(msg):
+                results.append(msg)
+                continue
+            user = msg
+        elif role == "assistant":
+            msg_id = msg["message"].get("id")
+            if msg_id == current_id:
+                parts.append(msg)
+            else:
+                if current_id and parts:
+                    assistants.append(hook.merge_assistant_parts(parts))
+                current_id, parts = msg_id, [msg]
+    if current_id and parts:
+        assistants.append(hook.merge_assistant_parts(parts))
+
+    hook.get_text_content(user)
+    hook.get_text_content(assistants[-1])
+    tool_calls = []
+    for assistant in assistants:
+        for tool_call in hook.get_tool_calls(assistant):
+            output = None
+            for tr in results:
+                for item in hook.get_content(tr):
+                    if isinstance(item, dict) and item.get("tool_use_id") == tool_call.get("id"):
+                        output = item.get("content")
+                        break
+            tool_calls.append((tool_call.get("name"), output))
+    return tool_calls
+
+
+def single_pass_pipeline(lines: list) -> list:
+    grouper = TurnGrouper()
+    for msg in lines:
+        grouper.add(msg)
+    turn = grouper.current
+    turn.assistants[-1].text
+    return [(tool_call.name, tool_call.output) for tool_call in turn.tool_calls]
+
+
+def ns_per_line(func, lines: list) -> float:
+    number = max(200, 400_000 // len(lines))
+    best = min(timeit.repeat(lambda: func(lines), number=number, repeat=5))
+    return best / (number * len(lines)) * 1e9
+
+
+if __name__ == "__main__":
+    baseline = load_baseline(sys.argv[1] if len(sys.argv) > 1 else None)
+    original = lambda lines: original_pipeline(baseline, lines)
+    print(f"{'tool steps':>10} {'lines':>6} {'original ns/line':>17} {'single ns/line':>15} {'reduction':>10}")
+    for tool_steps in TOOL_STEPS:
+        lines = make_turn(tool_steps)
+        assert original(lines) == single_pass_pipeline(lines)
+        before = ns_per_line(original, lines)
+        after = ns_per_line(single_pass_pipeline, lines)
+        print(f"{tool_steps:>10} {len(lines):>6} {before:>17.1f} {after:>15.1f} {(1 - after / before) * 100:>9.1f}%")
@@ -3,7 +3,10 @@
 
 Tests the pure utility functions without requiring the langfuse package.
 """
+import json
 import sys
+import tempfile
+from contextlib import contextmanager
 from pathlib import Path
 from unittest.mock import MagicMock
 
@@ -13,7 +16,51 @@ sys.modules['langfuse'] = MagicMock()
 # Add hooks directory to path
 sys.path.insert(0, str(Path(__file__).parent.parent / 'hooks'))
 
-from langfuse_hook import extract_project_name, get_text_content, is_tool_result, get_content, merge_assistant_parts
+from langfuse_hook import extract_project_name
+from langfuse_hook import build_turn_record, record_partition, JsonlSink, NullSink, Sink, process_transcript
+from langfuse_hook import sanitize_value, Turn, TurnGrouper, TranscriptIndex, message_content, message_role, text_parts
+from langfuse_hook import create_trace, install_stable_ids, parse_turn_range, prioritize_transcripts
+from langfuse_hook import describe_transcript, rotate_log_if_needed, build_session_summary, load_routes, RoutingLangfuseSink
+from langfuse_hook import ColumnarSink, InotifyWatcher, env_number, start_profiling, finish_profiling
+import langfuse_hook
+
+# Module-level paths the hook writes to, redirected per test by hook_paths()
+HOOK_PATHS = {
+    "STATE_FILE": "state.json",
+    "LOCK_FILE": "state.lock",
+    "RUN_LOCK_FILE": "run.lock",
+    "INDEX_DIR": "index",
+    "MEDIA_DIR": "media",
+    "PROFILE_DIR": "profiles",
+    "LOG_FILE": "hook.log",
+}
+
+
+@contextmanager
+def hook_paths():
+    """Point the hook's state, index, media and log paths into a temp dir, restoring them afterwards."""
+    saved = {name: getattr(langfuse_hook, name) for name in HOOK_PATHS}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, filename in HOOK_PATHS.items():
+            setattr(langfuse_hook, name, Path(tmp) / filename)
+        try:
+            yield Path(tmp)
+        finally:
+            for name, value in saved.items():
+                setattr(langfuse_hook, name, value)
+
+
+@contextmanager
+def hook_settings(**values):
+    """Temporarily override module-level settings such as CHECKPOINT_TURNS."""
+    saved = {name: getattr(langfuse_hook, name) for name in values}
+    for name, value in values.items():
+        setattr(langfuse_hook, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(langfuse_hook, name, value)
 
 
 def test_extract_project_name():
@@ -32,120 +79,678 @@ def test_extract_project_name():
     print("✓ extract_project_name tests passed")
 
 
-def test_get_content():
-    """Test content extraction from various message formats."""
-    # Direct content field
-    assert get_content({"content": "hello"}) == "hello"
-
-    # Nested message format
-    assert get_content({"message": {"content": "nested"}}) == "nested"
-
-    # List content
-    content_list = [{"type": "text", "text": "hello"}]
-    assert get_content({"content": content_list}) == content_list
-
-    # Empty/missing content
-    assert get_content({}) is None
-    assert get_content({"other": "field"}) is None
-
-    print("✓ get_content tests passed")
-
-
-def test_get_text_content():
-    """Test text extraction from messages."""
-    # String content
-    assert get_text_content({"content": "hello"}) == "hello"
-
-    # List content with text blocks
-    assert get_text_content({"content": [{"type": "text", "text": "hello"}]}) == "hello"
-
-    # Multiple text blocks
-    multi_text = {"content": [
-        {"type": "text", "text": "hello"},
-        {"type": "text", "text": "world"}
-    ]}
-    assert get_text_content(multi_text) == "hello\nworld"
-
-    # Mixed content (text and tool_use)
-    mixed = {"content": [
-        {"type": "text", "text": "thinking..."},
-        {"type": "tool_use", "name": "Read", "input": {}}
-    ]}
-    assert get_text_content(mixed) == "thinking..."
-
-    # Nested message format
-    assert get_text_content({"message": {"content": "nested"}}) == "nested"
-
-    # Empty content
-    assert get_text_content({"content": []}) == ""
-    assert get_text_content({}) == ""
-
-    print("✓ get_text_content tests passed")
-
-
-def test_is_tool_result():
-    """Test tool result detection."""
-    # Tool result message
-    tool_result_msg = {"content": [{"type": "tool_result", "tool_use_id": "123", "content": "result"}]}
-    assert is_tool_result(tool_result_msg) == True
-
-    # Regular text message
-    text_msg = {"content": [{"type": "text", "text": "hello"}]}
-    assert is_tool_result(text_msg) == False
-
-    # String content (not a tool result)
-    assert is_tool_result({"content": "hello"}) == False
-
-    # Mixed content with tool result
-    mixed = {"content": [
-        {"type": "text", "text": "here's the result"},
-        {"type": "tool_result", "tool_use_id": "456"}
-    ]}
-    assert is_tool_result(mixed) == True
-
-    # Empty content
-    assert is_tool_result({"content": []}) == False
-    assert is_tool_result({}) == False
-
-    print("✓ is_tool_result tests passed")
-
-
-def test_merge_assistant_parts():
-    """Test merging multiple assistant message parts."""
-    # Empty input
-    assert merge_assistant_parts([]) == {}
-
-    # Single message (no merge needed)
-    single = [{"content": [{"type": "text", "text": "hello"}]}]
-    result = merge_assistant_parts(single)
-    assert result["content"] == [{"type": "text", "text": "hello"}]
-
-    # Multiple messages to merge
-    parts = [
-        {"content": [{"type": "text", "text": "part1"}]},
-        {"content": [{"type": "text", "text": "part2"}]}
-    ]
-    result = merge_assistant_parts(parts)
-    assert len(result["content"]) == 2
-    assert result["content"][0]["text"] == "part1"
-    assert result["content"][1]["text"] == "part2"
-
-    # Nested message format
-    nested_parts = [
-        {"message": {"content": [{"type": "text", "text": "nested1"}]}},
-        {"message": {"content": [{"type": "text", "text": "nested2"}]}}
+def test_build_turn_record():
+    """Test sink-agnostic turn record assembly."""
+    user = {"timestamp": "2026-03-01T10:00:00Z", "message": {"role": "user", "content": "run ls"}}
+    assistant = {"message": {"model": "claude-x", "content": [
+        {"type": "text", "text": "running"},
+        {"type": "tool_use", "id": "t1", "name": "Bash", "input": {"command": "ls"}},
+    ]}}
+    result = {"message": {"content": [{"type": "tool_result", "tool_use_id": "t1", "content": "a.txt"}]}}
+
+    turn = Turn(user)
+    turn.add_assistant_part(assistant)
+    turn.add_tool_results(message_content(result))
+    record = build_turn_record("s1", 3, turn, "proj")
+    assert record["session_id"] == "s1"
+    assert record["turn_number"] == 3
+    assert record["model"] == "claude-x"
+    assert record["input"] == "run ls"
+    assert record["output"] == "running"
+    tool_call = {k: v for k, v in record["tool_calls"][0].items() if k != "span_id"}
+    assert tool_call == {"name": "Bash", "input": {"command": "ls"}, "output": "a.txt", "is_error": False, "id": "t1"}
+    assert record_partition(record) == ("proj", "2026-03-01")
+
+    print("✓ build_turn_record tests passed")
+
+
+def test_message_helpers():
+    """Test role, content and text extraction from transcript lines."""
+    # Nested message format; role falls back to message.role
+    assert message_role({"type": "assistant", "message": {"role": "x"}}) == "assistant"
+    assert message_role({"message": {"role": "user", "content": "hi"}}) == "user"
+    assert message_content({"message": {"content": "nested"}}) == "nested"
+
+    # Flat content format
+    assert message_role({"type": "user", "content": "hi"}) == "user"
+    assert message_content({"content": [{"type": "text", "text": "x"}]}) == [{"type": "text", "text": "x"}]
+
+    # Not a message
+    assert message_role({}) is None
+    assert message_role(["not", "a", "message"]) is None
+    assert message_content({"other": "field"}) is None
+
+    # Text blocks and bare strings, skipping tool blocks
+    assert text_parts("hello") == ["hello"]
+    assert text_parts([
+        {"type": "text", "text": "a"},
+        "b",
+        {"type": "tool_use", "id": "t1", "name": "Read"},
+        {"type": "tool_result", "tool_use_id": "t0"},
+    ]) == ["a", "b"]
+    assert text_parts([]) == [] and text_parts(None) == []
+
+    print("✓ message helper tests passed")
+
+
+def test_turn_grouper():
+    """Test grouping lines into typed turns, merging assistant parts by id."""
+    grouper = TurnGrouper()
+    lines = [
+        {"type": "assistant", "message": {"id": "m0", "content": "orphan before any prompt"}},
+        {"type": "user", "message": {"role": "user", "content": "q1"}},
+        {"type": "assistant", "message": {"id": "m1", "model": "claude-x", "content": [{"type": "text", "text": "a"}]}},
+        {"type": "assistant", "message": {"id": "m1", "content": [{"type": "tool_use", "id": "t1", "name": "Read", "input": {}}]}},
+        {"type": "user", "message": {"content": [{"type": "tool_result", "tool_use_id": "t1", "content": "x", "is_error": True}]}},
+        {"type": "assistant", "message": {"id": "m2", "stop_reason": "end_turn", "content": [{"type": "text", "text": "b"}, "c"]}},
+        {"type": "user", "message": {"role": "user", "content": "q2"}},
     ]
-    result = merge_assistant_parts(nested_parts)
-    assert "message" in result
-    assert len(result["message"]["content"]) == 2
-
-    print("✓ merge_assistant_parts tests passed")
+    finished = [turn for i, line in enumerate(lines) if (turn := grouper.add(line, i, i * 10))]
+
+    assert len(finished) == 1
+    turn = finished[0]
+    assert (turn.user_text, turn.line_index, turn.offset) == ("q1", 1, 10)
+    assert [a.msg_id for a in turn.assistants] == ["m1", "m2"]
+    assert turn.assistants[0].model == "claude-x"
+    assert turn.assistants[0].text == "a"
+    assert turn.assistants[1].text == "b\nc"
+    assert [(t.id, t.output, t.is_error) for t in turn.tool_calls] == [("t1", "x", True)]
+    assert turn.is_complete
+    assert grouper.current.user_text == "q2"
+    assert not grouper.current.is_complete
+
+    assert grouper.add(["not", "a", "message"]) is None
+
+    # Any final stop reason completes a turn; tool_use and streaming (None) don't
+    for stop_reason, complete in [("max_tokens", True), ("refusal", True), ("tool_use", False), (None, False)]:
+        grouper.add({"type": "assistant", "message": {"id": "m3", "stop_reason": stop_reason, "content": "d"}})
+        assert grouper.current.is_complete is complete
+
+    print("✓ turn_grouper tests passed")
+
+
+def test_inotify_watcher_recovers():
+    """Test the watcher rescans instead of dying when a new directory can't be watched."""
+    with hook_paths() as tmp:
+        root = tmp / "projects"
+        (root / "p1").mkdir(parents=True)
+        (root / "p1" / "s1.jsonl").write_text("")
+        try:
+            watcher = InotifyWatcher(root)
+        except OSError:
+            print("✓ inotify watcher tests skipped (inotify unavailable)")
+            return
+        try:
+            def vanished(path):
+                raise OSError(f"{path} was removed")
+
+            add_dir, watcher.add_dir = watcher.add_dir, vanished
+            (root / "p2").mkdir()
+            (root / "p2" / "s2.jsonl").write_text("")
+            assert watcher.read_changes(1.0) == {root / "p1" / "s1.jsonl", root / "p2" / "s2.jsonl"}
+
+            # The next rescan picks the directory up once it can be watched
+            watcher.add_dir = add_dir
+            assert root / "p2" not in watcher.dirs.values()
+            watcher.rescan()
+            assert root / "p2" in watcher.dirs.values()
+        finally:
+            watcher.close()
+
+    print("✓ inotify watcher tests passed")
+
+
+def test_deterministic_ids():
+    """Test trace/span ids are stable across exports and applied to spans."""
+    turn = Turn({"message": {"content": "q"}})
+    turn.add_assistant_part({"message": {"id": "m1", "content": [
+        {"type": "tool_use", "id": "toolu_1", "name": "Read", "input": {}},
+        {"type": "tool_use", "id": "", "name": "Bash", "input": {}},
+    ]}})
+    record = build_turn_record("s1", 4, turn)
+    again = build_turn_record("s1", 4, turn)
+    assert record["trace_id"] == again["trace_id"] and len(record["trace_id"]) == 32
+    assert [t["span_id"] for t in record["tool_calls"]] == [t["span_id"] for t in again["tool_calls"]]
+    assert len({record["span_id"], record["generation_id"], *(t["span_id"] for t in record["tool_calls"])}) == 4
+    assert build_turn_record("s1", 5, turn)["trace_id"] != record["trace_id"]
+
+    # Span ids are handed to the tracer in creation order
+    client = MagicMock()
+    client._otel_tracer.id_generator.generate_span_id.return_value = 7
+    ids = install_stable_ids(client)
+    seen = []
+    client.start_as_current_span.side_effect = lambda **kw: (seen.append(ids.generate_span_id()), MagicMock())[1]
+    client.start_as_current_observation.side_effect = lambda **kw: (seen.append(ids.generate_span_id()), MagicMock())[1]
+    create_trace(client, record, ids)
+    expected = [record["span_id"], record["generation_id"]] + [t["span_id"] for t in record["tool_calls"]]
+    assert seen == [int(span_id, 16) for span_id in expected]
+    assert client.start_as_current_span.call_args_list[0].kwargs["trace_context"] == {"trace_id": record["trace_id"]}
+    assert ids.generate_span_id() == 7
+
+    assert parse_turn_range("5") == (5, 5)
+    assert parse_turn_range("3-7") == (3, 7)
+    assert parse_turn_range("2-")[0] == 2
+
+    print("✓ deterministic id tests passed")
+
+
+def test_jsonl_sink():
+    """Test NDJSON sink partitions records by project and day."""
+    record = {"session_id": "s1", "turn_number": 1, "project": "my/proj", "timestamp": "2026-03-01T23:59:00Z",
+              "model": "claude", "input": "hi", "output": "hello", "tool_calls": []}
+    with hook_paths() as tmp:
+        sink = JsonlSink(tmp)
+        sink.emit(record)
+        sink.emit(dict(record, turn_number=2))
+        sink.flush()
+        sink.shutdown()
+        lines = (tmp / "my_proj" / "2026-03-01.jsonl").read_text().splitlines()
+        assert [json.loads(line)["turn_number"] for line in lines] == [1, 2]
+
+    # Null sink accepts anything
+    NullSink().emit(record)
+
+    # A sink without emit() cannot be built
+    class Incomplete(Sink):
+        name = "incomplete"
+    try:
+        Incomplete()
+        assert False, "sink without emit() was built"
+    except TypeError:
+        pass
+
+    print("✓ jsonl_sink tests passed")
+
+
+def test_columnar_sink_staging():
+    """Test columnar rows are staged on flush and rolled into few files."""
+    record = {"trace_id": "t1", "session_id": "s1", "turn_number": 1, "project": "proj", "timestamp": "2026-03-01T10:00:00Z",
+              "model": "claude", "input": "hi", "output": "hello",
+              "tool_calls": [{"span_id": "sp1", "id": "tu1", "name": "Read", "is_error": False, "input": {}, "output": "x"}]}
+    written = []
+
+    class RecordingColumnarSink(ColumnarSink):
+        def _write_file(self, path, rows):
+            path.write_text("")
+            written.append((path.parent.parent.parent.name, rows))
+
+    with hook_paths() as tmp:
+        sink = RecordingColumnarSink(tmp)
+        for turn_number in (1, 2):
+            sink.emit(dict(record, turn_number=turn_number))
+            sink.flush()
+        assert written == []
+        staged = list((tmp / ".staging" / "turns" / "project=proj" / "date=2026-03-01").glob("rows-*.jsonl"))
+        assert len(staged) == 1
+        assert [json.loads(line)["turn_number"] for line in staged[0].read_text().splitlines()] == [1, 2]
+
+        # A later run (here: shutdown with the age limit passed) rolls each staging file into one part
+        with hook_settings(COLUMNAR_ROLL_SECONDS=0):
+            sink.emit(dict(record, turn_number=3))
+            sink.shutdown()
+        assert sorted((table, len(rows)) for table, rows in written) == [("tool_calls", 3), ("turns", 3)]
+        assert not list((tmp / ".staging").rglob("*.jsonl"))
+        assert len(list((tmp / "turns" / "project=proj" / "date=2026-03-01").glob("part-*.parquet"))) == 1
+
+    print("✓ columnar sink staging tests passed")
+
+
+def test_sanitize_value_offloads_media():
+    """Test base64 image blocks are stored once and replaced by references."""
+    import base64
+    png = b"\x89PNG fake image bytes"
+    data = base64.b64encode(png).decode()
+    block = {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": data}}
+
+    with hook_paths() as tmp:
+        output = sanitize_value([{"type": "text", "text": "password=hunter2hunter2"}, block, block])
+        assert output[0]["text"] == "password: [REDACTED]"
+        ref = output[1]["source"]
+        assert ref["type"] == "media_ref"
+        assert ref["bytes"] == len(png)
+        assert Path(ref["path"]).read_bytes() == png
+        assert output[2]["source"] == ref
+        assert len(list(tmp.rglob("*.png"))) == 1
+
+        # Data URIs are offloaded too
+        uri_ref = sanitize_value(f"data:image/png;base64,{data}")
+        assert uri_ref["sha256"] == ref["sha256"]
+
+    print("✓ sanitize_value media offload tests passed")
+
+
+class RecordingSink(Sink):
+    """Collects emitted records for assertions."""
+
+    def __init__(self):
+        self.records = []
+        self.summaries = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def emit_session(self, summary):
+        self.summaries.append(summary)
+
+
+def _line(role, content, msg_id=None, stop_reason=None):
+    message = {"role": role, "content": content}
+    if msg_id:
+        message["id"] = msg_id
+        message["stop_reason"] = stop_reason
+    return json.dumps({"type": role, "sessionId": "s1", "message": message}) + "\n"
+
+
+def test_process_transcript_incremental():
+    """Test byte-offset cursors, partial tail lines and held open turns."""
+    with hook_paths() as tmp:
+        transcript = tmp / "s1.jsonl"
+        transcript.write_text(
+            _line("user", "first")
+            + _line("assistant", [{"type": "text", "text": "one"}], "m1", "end_turn")
+            + _line("user", "second")
+            + _line("assistant", [{"type": "text", "text": "working"}], "m2")
+            + '{"type": "assist'
+        )
+        sink = RecordingSink()
+        state = {}
+
+        # Watch mode: second turn is still open, partial tail is not consumed
+        assert process_transcript(sink, "s1", transcript, state, hold_open_turn=True) == 1
+        assert [r["output"] for r in sink.records] == ["one"]
+        assert state["s1"]["last_line"] == 2
+        assert state["s1"]["last_offset"] == len((_line("user", "first") + _line("assistant", [{"type": "text", "text": "one"}], "m1", "end_turn")).encode())
+
+        # Finish the partial line and the turn
+        content = transcript.read_text()
+        content = content[:content.rindex("\n") + 1] + _line("assistant", [{"type": "text", "text": "two"}], "m3", "end_turn")
+        transcript.write_text(content)
+        assert process_transcript(sink, "s1", transcript, state, hold_open_turn=True) == 1
+        assert sink.records[-1]["turn_number"] == 2
+        assert sink.records[-1]["output"] == "two"
+        assert state["s1"]["last_line"] == 5
+        assert state["s1"]["last_offset"] == transcript.stat().st_size
+
+        # Nothing new to read
+        assert process_transcript(sink, "s1", transcript, state) == 0
+
+        # Legacy line-count cursor is converted to a byte offset
+        legacy = {"s1": {"last_line": 2, "turn_count": 1}}
+        assert process_transcript(RecordingSink(), "s1", transcript, legacy) == 1
+        assert legacy["s1"]["last_offset"] == transcript.stat().st_size
+
+        # A Stop run that lands between a prompt and its reply keeps the prompt,
+        # so incremental numbering matches replay's
+        project = tmp / "-Users-x-proj"
+        project.mkdir()
+        racing = project / "s2.jsonl"
+        racing.write_text(_line("user", "q1") + _line("assistant", [{"type": "text", "text": "a1"}], "m1") + _line("user", "q2"))
+        incremental = RecordingSink()
+        assert process_transcript(incremental, "s2", racing, state) == 1
+        with open(racing, "a") as f:
+            f.write(_line("assistant", [{"type": "text", "text": "a2"}], "m2") + _line("user", "q3")
+                    + _line("assistant", [{"type": "text", "text": "a3"}], "m3"))
+        assert process_transcript(incremental, "s2", racing, state) == 2
+        replayed = RecordingSink()
+        with hook_settings(PROJECTS_DIR=tmp):
+            assert langfuse_hook.replay(replayed, "s2") == 3
+        numbered = lambda sink: [(r["turn_number"], r["input"]) for r in sink.records]
+        assert numbered(incremental) == numbered(replayed) == [(1, "q1"), (2, "q2"), (3, "q3")]
+
+    print("✓ process_transcript incremental tests passed")
+
+
+def test_process_transcript_deadline_and_checkpoints():
+    """Test a passed deadline stops after one turn and the next run resumes."""
+    with hook_paths() as tmp:
+        transcript = tmp / "s1.jsonl"
+        lines = [_line("user", f"q{i}") + _line("assistant", [{"type": "text", "text": f"a{i}"}], f"m{i}") for i in range(4)]
+        transcript.write_text("".join(lines))
+
+        sink = RecordingSink()
+        state = {}
+        assert process_transcript(sink, "s1", transcript, state, deadline=0.0) == 1
+        assert state["s1"]["turn_count"] == 1
+        assert state["s1"]["last_offset"] == len(lines[0].encode())
+
+        # Checkpoints persist the cursor every N turns; the sink is flushed before
+        # each save, so the saved cursor never covers unflushed turns
+        saved = []
+        sink.flush = lambda: saved.append(json.loads(langfuse_hook.STATE_FILE.read_text())["s1"]["turn_count"])
+        with hook_settings(CHECKPOINT_TURNS=1):
+            assert process_transcript(sink, "s1", transcript, state) == 3
+        assert saved == [1, 2, 3]
+        assert [r["output"] for r in sink.records] == ["a0", "a1", "a2", "a3"]
+        assert state["s1"]["turn_count"] == 4
+
+    # A budgeted run waits for the run lock only until its deadline
+    import fcntl
+    import time
+    with hook_paths():
+        langfuse_hook.RUN_LOCK_FILE.touch()
+        with open(langfuse_hook.RUN_LOCK_FILE) as holder:
+            fcntl.flock(holder, fcntl.LOCK_EX)
+            start = time.monotonic()
+            try:
+                with langfuse_hook.run_lock(start + 0.3):
+                    assert False, "run lock acquired while held"
+            except TimeoutError:
+                pass
+            assert 0.3 <= time.monotonic() - start < 2
+            fcntl.flock(holder, fcntl.LOCK_UN)
+            with langfuse_hook.run_lock(time.monotonic() + 0.3):
+                pass
+
+    # The session that fired Stop goes first, the rest keep their order
+    transcripts = [("a", Path("a.jsonl"), "p"), ("b", Path("b.jsonl"), "p"), ("c", Path("c.jsonl"), "p")]
+    assert [t[0] for t in prioritize_transcripts(transcripts, {"session_id": "c"})] == ["c", "a", "b"]
+    assert [t[0] for t in prioritize_transcripts(transcripts, {"transcript_path": "b.jsonl"})] == ["b", "a", "c"]
+    assert prioritize_transcripts(transcripts, {}) == transcripts
+
+    print("✓ process_transcript deadline/checkpoint tests passed")
+
+
+def test_session_rollups():
+    """Test per-session aggregates in state and throttled summary emission."""
+    def line(role, content, ts, msg_id=None, stop_reason=None):
+        entry = json.loads(_line(role, content, msg_id, stop_reason))
+        entry["timestamp"] = ts
+        return json.dumps(entry) + "\n"
+
+    with hook_paths() as tmp:
+        transcript = tmp / "s1.jsonl"
+        transcript.write_text(
+            line("user", "q1", "2026-03-01T10:00:00Z")
+            + line("assistant", [{"type": "tool_use", "id": "t1", "name": "Bash", "input": {}},
+                                 {"type": "tool_use", "id": "t2", "name": "Read", "input": {}}], "2026-03-01T10:00:05Z", "m1")
+            + line("user", [{"type": "tool_result", "tool_use_id": "t1", "content": "boom", "is_error": True},
+                            {"type": "tool_result", "tool_use_id": "t2", "content": "ok"}], "2026-03-01T10:00:10Z")
+            + line("assistant", "done", "2026-03-01T10:00:20Z", "m2", "end_turn")
+            + line("user", "q2", "2026-03-01T10:05:00Z")
+            + line("assistant", [{"type": "tool_use", "id": "t3", "name": "Bash", "input": {}}], "2026-03-01T10:05:30Z", "m3", "end_turn")
+        )
+        sink = RecordingSink()
+        state = {}
+        assert process_transcript(sink, "s1", transcript, state, "proj") == 2
+
+        rollup = state["s1"]["rollup"]
+        assert (rollup["turns"], rollup["tool_calls"], rollup["tool_errors"]) == (2, {"Bash": 2, "Read": 1}, 1)
+        assert rollup["active_seconds"] == 50.0
+        # "q1" + "done" + "boom" + "ok" (tool inputs are empty), then "q2" + ""
+        assert rollup["content_chars"] == 14
+        assert len(sink.summaries) == 1
+        summary = sink.summaries[0]
+        assert (summary["turns"], summary["tool_call_count"], summary["wall_seconds"]) == (2, 3, 330.0)
+        assert summary["trace_id"] == build_session_summary("s1", "proj", rollup)["trace_id"]
+
+        # A new turn inside SUMMARY_INTERVAL is aggregated but not summarized...
+        with open(transcript, "a") as f:
+            f.write(line("user", "q3", "2026-03-01T11:00:00Z") + line("assistant", "a3", "2026-03-01T11:00:01Z", "m4", "end_turn"))
+        assert process_transcript(sink, "s1", transcript, state, "proj") == 1
+        assert (state["s1"]["rollup"]["turns"], len(sink.summaries)) == (3, 1)
+
+        # ...until a later run with nothing new to read, once the interval has passed
+        with hook_settings(SUMMARY_INTERVAL=0):
+            assert process_transcript(sink, "s1", transcript, state, "proj") == 0
+        assert sink.summaries[-1]["turns"] == 3
+        assert json.loads(langfuse_hook.STATE_FILE.read_text())["s1"]["rollup"]["summarized_turns"] == 3
+
+        # The JSONL sink keeps one summary file per session
+        jsonl = JsonlSink(tmp / "export")
+        jsonl.emit_session(summary)
+        jsonl.emit_session(sink.summaries[-1])
+        assert json.loads((tmp / "export" / "proj" / "sessions" / "s1.json").read_text())["turns"] == 3
+
+    print("✓ session rollup tests passed")
+
+
+def test_project_routing():
+    """Test routing projects to pooled Langfuse clients by glob."""
+    with hook_paths() as tmp:
+        routes_file = tmp / "routes.json"
+        routes_file.write_text(json.dumps({"routes": [
+            {"project": "acme-*", "public_key": "pk-acme", "secret_key": "sk-acme", "host": "http://acme"},
+            {"project": "acme-web", "public_key": "pk-unused", "secret_key": "sk-unused"},
+            {"project": "broken"},
+        ]}))
+        routes = load_routes(routes_file)
+        assert [r["public_key"] for r in routes] == ["pk-acme", "pk-unused"]
+        assert load_routes(tmp / "missing.json") == []
+        routes_file.write_text("[]")
+        assert load_routes(routes_file) == []
+
+    created = []
+    original = langfuse_hook.create_langfuse_client
+    langfuse_hook.create_langfuse_client = lambda *creds: created.append(creds) or MagicMock()
+    try:
+        sink = RoutingLangfuseSink(routes)
+        for project in ["acme-api", "acme-web", "other", "acme-api", ""]:
+            sink.route(project)
+        sink.emit_session(build_session_summary("s1", "acme-api", {"turns": 1}))
+    finally:
+        langfuse_hook.create_langfuse_client = original
+
+    # First matching glob wins; clients are created once per credential set
+    assert created == [("pk-acme", "sk-acme", "http://acme"), (None, None, None)]
+    assert sink.route("acme-web") is sink.route("acme-api")
+    assert sink.route("other") is not sink.route("acme-api")
+    assert sink.route("acme-api").client.create_score.called
+    assert not sink.route("other").client.create_score.called
+
+    sink.flush()
+    sink.shutdown()
+    for pooled in (sink.route("acme-api"), sink.route("other")):
+        pooled.client.flush.assert_called_once()
+        pooled.client.shutdown.assert_called_once()
+
+    print("✓ project routing tests passed")
+
+
+def test_profiling_and_settings():
+    """Test slow-mode captures are kept above the threshold and pruned to PROFILE_KEEP."""
+    with hook_paths() as tmp, hook_settings(PROFILE_MODE="slow", PROFILE_THRESHOLD=10.0, PROFILE_KEEP=2):
+        finish_profiling(start_profiling(), 1.0)
+        assert not langfuse_hook.PROFILE_DIR.exists()
+
+        langfuse_hook.PROFILE_DIR.mkdir()
+        for stamp in ("20200101_000000_1", "20200102_000000_1"):
+            (langfuse_hook.PROFILE_DIR / f"{stamp}.pstats").write_text("")
+            (langfuse_hook.PROFILE_DIR / f"{stamp}.txt").write_text("")
+        finish_profiling(start_profiling(), 20.0)
+        kept = sorted(path.name for path in langfuse_hook.PROFILE_DIR.iterdir())
+        assert len(kept) == 4
+        assert kept[:2] == ["20200102_000000_1.pstats", "20200102_000000_1.txt"]
+        assert "Run duration: 20.0s" in (langfuse_hook.PROFILE_DIR / kept[3]).read_text()
+
+    # Unparseable numeric settings fall back to their defaults instead of raising
+    import os
+    os.environ["CC_LANGFUSE_TEST_NUMBER"] = "soon"
+    try:
+        assert env_number("CC_LANGFUSE_TEST_NUMBER", 5, int) == 5
+        assert "CC_LANGFUSE_TEST_NUMBER" in langfuse_hook.CONFIG_WARNINGS.pop()
+        os.environ["CC_LANGFUSE_TEST_NUMBER"] = "2.5"
+        assert env_number("CC_LANGFUSE_TEST_NUMBER", 5.0) == 2.5
+        # Out-of-range values are clamped, with a warning
+        os.environ["CC_LANGFUSE_TEST_NUMBER"] = "0"
+        assert env_number("CC_LANGFUSE_TEST_NUMBER", 1, int, 1, 65535) == 1
+        assert "Clamping CC_LANGFUSE_TEST_NUMBER" in langfuse_hook.CONFIG_WARNINGS.pop()
+        os.environ["CC_LANGFUSE_TEST_NUMBER"] = "70000"
+        assert env_number("CC_LANGFUSE_TEST_NUMBER", 1, int, 1, 65535) == 65535
+        langfuse_hook.CONFIG_WARNINGS.pop()
+    finally:
+        del os.environ["CC_LANGFUSE_TEST_NUMBER"]
+    assert env_number("CC_LANGFUSE_TEST_NUMBER", 5.0) == 5.0
+
+    # A profiler that cannot start is skipped rather than aborting the run
+    with hook_paths(), hook_settings(PROFILE_MODE="always", PROFILE_TRACE_FRAMES=0):
+        assert start_profiling() is None
+        assert "Profiling disabled" in langfuse_hook.LOG_FILE.read_text()
+
+    print("✓ profiling/settings tests passed")
+
+
+def test_compressed_transcripts_and_logs():
+    """Test archived .jsonl.gz transcripts continue from the live file's cursor."""
+    import gzip
+    with hook_paths() as tmp:
+        live = tmp / "-Users-x-proj" / "s1.jsonl"
+        live.parent.mkdir()
+        first = _line("user", "q1") + _line("assistant", [{"type": "text", "text": "a1"}], "m1")
+        live.write_text(first)
+
+        sink = RecordingSink()
+        state = {}
+        assert process_transcript(sink, "s1", live, state) == 1
+
+        # Retention job archives the file after more turns were appended
+        archive = live.with_name("s1.jsonl.gz")
+        with gzip.open(archive, "wt") as f:
+            f.write(first + _line("user", "q2") + _line("assistant", [{"type": "text", "text": "a2"}], "m2"))
+        live.unlink()
+        assert describe_transcript(archive) == ("s1", archive, "proj")
+        opened = []
+        open_transcript = langfuse_hook.open_transcript
+        with hook_settings(open_transcript=lambda path: opened.append(path) or open_transcript(path)):
+            assert process_transcript(sink, "s1", archive, state) == 1
+        assert opened == [archive]  # decompressed once, no index catch-up pass
+        assert [r["turn_number"] for r in sink.records] == [1, 2]
+        assert process_transcript(sink, "s1", archive, state) == 0
+
+        # .jsonl.zst archives seek forward to the live file's cursor too
+        if langfuse_hook.zstandard is not None:
+            zst_live = live.with_name("s4.jsonl")
+            zst_live.write_text(first)
+            assert process_transcript(sink, "s4", zst_live, state) == 1
+            zst_archive = live.with_name("s4.jsonl.zst")
+            zst_archive.write_bytes(langfuse_hook.zstandard.ZstdCompressor().compress(
+                (first + _line("user", "q2") + _line("assistant", [{"type": "text", "text": "z2"}], "m2")).encode()))
+            zst_live.unlink()
+            assert process_transcript(sink, "s4", zst_archive, state) == 1
+            assert sink.records[-1]["output"] == "z2"
+            with langfuse_hook.open_transcript(zst_archive) as f:
+                assert f.seek(len(first.encode())) == len(first.encode()) and json.loads(f.readline())["message"]["content"] == "q2"
+
+        # A corrupt deflate body (zlib.error, not OSError) is skipped, not fatal to the run
+        corrupt = live.with_name("s2.jsonl.gz")
+        body = bytearray(gzip.compress(first.encode()))
+        body[10] = 0xff  # first deflate block header: invalid block type
+        corrupt.write_bytes(bytes(body))
+        with hook_settings(PROJECTS_DIR=tmp):
+            names = [path.name for _, path, _ in langfuse_hook.find_all_transcripts()]
+        assert "s1.jsonl.gz" in names and "s2.jsonl.gz" not in names
+        try:
+            process_transcript(sink, "s2", corrupt, state)
+            assert False, "corrupt archive was read"
+        except langfuse_hook.TRANSCRIPT_READ_ERRORS:
+            pass
+
+        # An archive failing mid-stream (bad CRC after all turns were read) emits
+        # its turns once, then is skipped until the file changes
+        damaged = live.with_name("s5.jsonl.gz")
+        two_turns = first + _line("user", "q2") + _line("assistant", [{"type": "text", "text": "a2"}], "m2")
+        body = bytearray(gzip.compress(two_turns.encode()))
+        body[-8] ^= 0xff  # CRC32 trailer
+        damaged.write_bytes(bytes(body))
+        emitted = len(sink.records)
+        for _ in range(3):
+            try:
+                process_transcript(sink, "s5", damaged, state)
+            except langfuse_hook.TRANSCRIPT_READ_ERRORS:
+                pass
+        assert len(sink.records) - emitted == 1  # the trailing turn is only emitted at EOF
+        assert state["s5"]["failed_size"] == len(body)
+        damaged.write_bytes(gzip.compress((two_turns + _line("user", "q3")).encode()))
+        assert process_transcript(sink, "s5", damaged, state) == 2
+        assert "failed_size" not in state["s5"]
+
+        # A line that is not UTF-8 counts as malformed
+        garbled = live.with_name("s3.jsonl")
+        garbled.write_bytes(b'{"type": "user", "message": {"content": "\xff"}}\n' + first.encode())
+        assert process_transcript(sink, "s3", garbled, state) == 1
+        assert state["s3"]["bad_line_count"] == 1
+
+        # Rotated hook logs are gzipped
+        langfuse_hook.LOG_FILE.write_text("x" * (langfuse_hook.LOG_MAX_SIZE_BYTES + 1))
+        rotate_log_if_needed()
+        assert not langfuse_hook.LOG_FILE.exists()
+        with gzip.open(tmp / "hook.log.1.gz", "rt") as f:
+            assert len(f.read()) == langfuse_hook.LOG_MAX_SIZE_BYTES + 1
+
+    print("✓ compressed transcript/log tests passed")
+
+
+def test_transcript_index():
+    """Test the sidecar index maintained while processing and its lookups."""
+    with hook_paths() as tmp:
+        transcript = tmp / "proj" / "s1.jsonl"
+        transcript.parent.mkdir()
+        first = _line("user", "q1") + _line("assistant", [{"type": "text", "text": "a1"}], "m1")
+        transcript.write_text(first + _line("user", "q2") + _line("assistant", [{"type": "text", "text": "a2"}], "m2"))
+
+        state = {}
+        assert process_transcript(RecordingSink(), "s1", transcript, state) == 2
+
+        index = TranscriptIndex(transcript)
+        assert index.line_count == 4
+        assert index.line_offset(2) == len(first.encode())
+        assert index.turn_entry(2) == {"turn": 2, "line": 2, "offset": len(first.encode()), "ids": ["m2"]}
+        assert [m["message"]["content"] for m in index.read_turn(1)] == ["q1", [{"type": "text", "text": "a1"}]]
+        assert index.read_turn(3) is None
+
+        # Lookups catch up on lines the hook has not processed yet
+        with open(transcript, "a") as f:
+            f.write(_line("assistant", [{"type": "text", "text": "late"}], "m3"))
+        assert index.last_assistant()["message"]["id"] == "m3"
+        assert TranscriptIndex(transcript).line_count == 5
+
+        # A later hook run does not duplicate already-indexed lines
+        assert process_transcript(RecordingSink(), "s1", transcript, state) == 0
+        assert TranscriptIndex(transcript).line_count == 5
+
+        # Two writers loading the same index (tracing hook + `index` lookup) don't duplicate offsets
+        with open(transcript, "a") as f:
+            f.write(_line("user", "q3"))
+        first_writer, second_writer = TranscriptIndex(transcript), TranscriptIndex(transcript)
+        first_writer.catch_up()
+        second_writer.catch_up()
+        first_writer.save()
+        second_writer.save()
+        with open(transcript, "a") as f:
+            f.write(_line("assistant", [{"type": "text", "text": "a3"}], "m4"))
+        second_writer.catch_up()
+        second_writer.save()
+        index = TranscriptIndex(transcript)
+        assert index.line_count == 7
+        assert index.lines_path.stat().st_size == 7 * 8
+        assert index.line_offset(2) == len(first.encode())
+
+        # `index line N` seeks straight to the line
+        import argparse
+        import contextlib
+        import io
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            assert langfuse_hook.index_command(argparse.Namespace(transcript=transcript, index_command="line", line=3)) == 0
+        assert json.loads(out.getvalue())["message"]["content"] == "q2"
+
+    print("✓ transcript_index tests passed")
 
 
 if __name__ == "__main__":
     test_extract_project_name()
-    test_get_content()
-    test_get_text_content()
-    test_is_tool_result()
-    test_merge_assistant_parts()
+    test_build_turn_record()
+    test_message_helpers()
+    test_turn_grouper()
+    test_inotify_watcher_recovers()
+    test_deterministic_ids()
+    test_jsonl_sink()
+    test_columnar_sink_staging()
+    test_sanitize_value_offloads_media()
+    test_process_transcript_incremental()
+    test_process_transcript_deadline_and_checkpoints()
+    test_session_rollups()
+    test_project_routing()
+    test_profiling_and_settings()
+    test_compressed_transcripts_and_logs()
+    test_transcript_index()
     print("\nAll unit tests passed!")